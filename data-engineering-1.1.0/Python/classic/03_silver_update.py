@@ -139,7 +139,8 @@ bronzeDF.show()
 # COMMAND ----------
 
 bronzeDF = read_batch_bronze(spark, bronzePath)
-transformedBronzeDF = transform_bronze(bronzeDF)
+# Cached so both writes and both status updates see the same rows.
+transformedBronzeDF = transform_bronze(bronzeDF).cache()
 
 (silverCleanDF, silverQuarantineDF) = generate_clean_and_quarantine_dataframes(
     transformedBronzeDF
@@ -152,6 +153,7 @@ bronzeToSilverWriter.save(silverPath)
 
 update_bronze_table_status(spark, bronzePath, silverCleanDF, "loaded")
 update_bronze_table_status(spark, bronzePath, silverQuarantineDF, "quarantined")
+transformedBronzeDF.unpersist()
 
 # COMMAND ----------
 
@@ -18,10 +18,11 @@ rawToBronzeWriter = batch_writer(
 
 rawToBronzeWriter.save(bronzePath)
 
-dbutils.fs.rm(rawPath, recurse=True)
+archive_raw_files(rawPath, rawArchivePath)
 
 bronzeDF = read_batch_bronze(spark, bronzePath)
-transformedBronzeDF = transform_bronze(bronzeDF)
+# Cached so both writes and both status updates see the same rows.
+transformedBronzeDF = transform_bronze(bronzeDF).cache()
 
 (silverCleanDF, silverQuarantineDF) = generate_clean_and_quarantine_dataframes(
     transformedBronzeDF
@@ -34,6 +35,7 @@ bronzeToSilverWriter.save(silverPath)
 
 update_bronze_table_status(spark, bronzePath, silverCleanDF, "loaded")
 update_bronze_table_status(spark, bronzePath, silverQuarantineDF, "quarantined")
+transformedBronzeDF.unpersist()
 
 silverCleanedDF = repair_quarantined_records(
     spark, bronzeTable="health_tracker_classic_bronze", userTable="health_tracker_user"
@@ -0,0 +1,56 @@
+# Databricks notebook source
+# MAGIC 
+# MAGIC %md
+# MAGIC # Unit Tests for Utilities
+
+# COMMAND ----------
+
+import gzip
+import json
+import os
+
+# COMMAND ----------
+
+from utilities import archive_raw_files, read_raw_archive_index
+
+# COMMAND ----------
+
+def _write_raw_file(path, times):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        "".join(json.dumps({"device_id": 0, "time": time}) + "\n" for time in times)
+    )
+
+
+def _archived_lines(archive):
+    lines = []
+    for entry in read_raw_archive_index(f"file:{archive}/"):
+        with gzip.open(os.path.join(archive, entry["segment"]), "rt") as f:
+            lines.extend(line for line in f if line.strip())
+    return lines
+
+
+# COMMAND ----------
+
+def test_archive_raw_files_rerun_does_not_duplicate(tmp_path):
+    raw, archive = tmp_path / "raw", tmp_path / "archive"
+    _write_raw_file(raw / "2020-01.json", [0, 100, 90000])
+    raw_path, archive_path = f"file:{raw}/", f"file:{archive}/"
+
+    first = archive_raw_files(raw_path, archive_path, remove=False)
+    assert sum(entry["record_count"] for entry in first) == 3
+
+    # The raw file is already in the index, so a rerun skips it.
+    assert archive_raw_files(raw_path, archive_path, remove=False) == []
+    assert len(_archived_lines(str(archive))) == 3
+
+    # A crash before the index was saved: the segments hold the records but
+    # the index does not list the raw file, so it is read again.
+    os.remove(archive / "_index.json")
+    archive_raw_files(raw_path, archive_path, remove=False)
+    assert len(_archived_lines(str(archive))) == 3
+
+    _write_raw_file(raw / "2020-02.json", [50])
+    archive_raw_files(raw_path, archive_path)
+    assert len(_archived_lines(str(archive))) == 4
+    assert not os.listdir(raw)
@@ -13,9 +13,14 @@ username = "hoia"
 plusPipelinePath = f"/dbacademy/{username}/dataengineering/plus/"
 
 rawPath = plusPipelinePath + "raw/"
+rawStagingPath = plusPipelinePath + "rawStaging/"
+rawStagingArchivePath = plusPipelinePath + "rawStagingArchive/"
+rawListingIndexPath = plusPipelinePath + "rawListingIndex/index.json"
 bronzePath = plusPipelinePath + "bronze/"
 silverPath = plusPipelinePath + "silver/"
 goldPath = plusPipelinePath + "gold/"
+silverQuarantinePath = plusPipelinePath + "silverQuarantine/"
+metricsPath = plusPipelinePath + "metrics/"
 
 checkpointPath = plusPipelinePath + "checkpoints/"
 bronzeCheckpoint = checkpointPath + "bronze/"
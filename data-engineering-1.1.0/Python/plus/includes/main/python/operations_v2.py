@@ -1,6 +1,6 @@
 # Databricks notebook source
 
-from delta.tables import DeltaTable
+from delta.exceptions import DeltaConcurrentModificationException
 from pyspark.sql import DataFrame
 from pyspark.sql.functions import (
     col,
@@ -17,6 +17,9 @@ from pyspark.sql.functions import (
 from pyspark.sql.session import SparkSession
 from pyspark.sql.streaming import DataStreamWriter
 from pyspark.sql.window import Window
+from typing import Callable, Dict
+import random
+import time
 
 # COMMAND ----------
 
@@ -44,6 +47,61 @@ def create_stream_writer(
     return stream_writer
 
 
+# COMMAND ----------
+
+def execute_merge(
+    spark: SparkSession,
+    deltaPath: str,
+    build_updates: Callable[[], DataFrame],
+    merge_condition: str,
+    apply_clauses: Callable,
+    partition_column: str = None,
+    target_alias: str = "target",
+    source_alias: str = "updates",
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+) -> Dict:
+    """Run a MERGE that tolerates concurrent writers to the same table.
+
+    When ``partition_column`` is given, the merge condition is narrowed to the
+    partition values present in the updates, so Delta's conflict detection
+    only checks those partitions and appends elsewhere do not conflict. On a
+    concurrent-modification conflict the updates are rebuilt against the new
+    snapshot and the MERGE is retried after a jittered exponential backoff.
+    Returns the number of attempts and conflicts.
+    """
+    conflicts = 0
+    for attempt in range(max_retries + 1):
+        updatesDF = build_updates()
+        condition = merge_condition
+        if partition_column is not None:
+            values = [
+                row[0]
+                for row in updatesDF.select(partition_column).distinct().collect()
+            ]
+            if not values:
+                return {"attempts": attempt + 1, "conflicts": conflicts}
+            value_list = ", ".join(f"'{value}'" for value in values)
+            condition = (
+                f"{target_alias}.{partition_column} IN ({value_list}) "
+                f"AND ({merge_condition})"
+            )
+
+        merge_builder = (
+            delta_table(spark, deltaPath)
+            .alias(target_alias)
+            .merge(updatesDF.alias(source_alias), condition)
+        )
+        try:
+            apply_clauses(merge_builder).execute()
+            return {"attempts": attempt + 1, "conflicts": conflicts}
+        except DeltaConcurrentModificationException:
+            conflicts += 1
+            if attempt == max_retries:
+                raise
+            time.sleep(base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
 # COMMAND ----------
 
 def read_stream_delta(spark: SparkSession, deltaPath: str) -> DataFrame:
@@ -71,28 +129,33 @@ def update_silver_table(spark: SparkSession, silverPath: str) -> bool:
 
     dateWindow = Window.orderBy("p_eventdate")
 
-    interpolatedDF = spark.read.table("health_tracker_plus_silver").select(
-        "*",
-        lag(col("heartrate")).over(dateWindow).alias("prev_amt"),
-        lead(col("heartrate")).over(dateWindow).alias("next_amt"),
-    )
-
-    updatesDF = interpolatedDF.where(col("heartrate") < 0).select(
-        "device_id",
-        ((col("prev_amt") + col("next_amt")) / 2).alias("heartrate"),
-        "eventtime",
-        "name",
-        "p_eventdate",
-    )
+    def build_updates() -> DataFrame:
+        # Rebuilt on every attempt so a retry sees the latest silver snapshot.
+        interpolatedDF = read_delta_snapshot(spark, silverPath).select(
+            "*",
+            lag(col("heartrate")).over(dateWindow).alias("prev_amt"),
+            lead(col("heartrate")).over(dateWindow).alias("next_amt"),
+        )
 
-    silverTable = DeltaTable.forPath(spark, silverPath)
+        return interpolatedDF.where(col("heartrate") < 0).select(
+            "device_id",
+            ((col("prev_amt") + col("next_amt")) / 2).alias("heartrate"),
+            "eventtime",
+            "name",
+            "p_eventdate",
+        )
 
-    (
-        silverTable.alias("health_tracker")
-        .merge(updatesDF.alias("updates"), update_match)
-        .whenMatchedUpdate(set=update)
-        .execute()
+    metrics = execute_merge(
+        spark,
+        silverPath,
+        build_updates=build_updates,
+        merge_condition=update_match,
+        apply_clauses=lambda merge: merge.whenMatchedUpdate(set=update),
+        partition_column="p_eventdate",
+        target_alias="health_tracker",
     )
+    if metrics["conflicts"]:
+        print(f"update_silver_table retried after {metrics['conflicts']} conflicts.")
 
     return True
 
@@ -0,0 +1,435 @@
+# Databricks notebook source
+# MAGIC 
+# MAGIC %md
+# MAGIC # Unit Tests for Utilities
+
+# COMMAND ----------
+
+import functools
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import pytest
+from pyspark import sql
+from pyspark.sql import SparkSession
+
+# COMMAND ----------
+
+spark = sql.SparkSession.builder.master("local[8]").getOrCreate()
+
+# COMMAND ----------
+
+from utilities import (
+    download_to_cache,
+    get_credential,
+    list_new_raw_files,
+    month_range,
+    notify_raw_files,
+    plan_vacuum,
+    read_delta_snapshot,
+    read_delta_snapshot_files,
+    read_delta_tombstones,
+    register_storage_location,
+    resolve_location,
+    retrieve_data_range,
+    table_row_count,
+    table_statistics,
+    use_local_storage,
+)
+
+# COMMAND ----------
+
+@pytest.fixture(scope="session")
+def spark_session(request):
+    """Fixture for creating a spark context."""
+    request.addfinalizer(lambda: spark.stop())
+
+    return spark
+
+
+@pytest.fixture
+def deletion_vector_table(spark_session: SparkSession, tmp_path):
+    """A two-file Delta table with one DELETE applied as a deletion vector.
+
+    A checkpoint is written on every commit, so replay starts from a
+    checkpoint that holds both the tombstone and the re-added file.
+    """
+    path = str(tmp_path / "dv_table")
+    spark_session.sql(
+        f"""
+        CREATE TABLE delta.`{path}` (id LONG) USING DELTA
+        TBLPROPERTIES (
+            'delta.enableDeletionVectors' = 'true',
+            'delta.checkpointInterval' = '1'
+        )
+        """
+    )
+    spark_session.range(0, 100, 1, 2).write.format("delta").mode("append").save(path)
+    spark_session.sql(f"DELETE FROM delta.`{path}` WHERE id < 10")
+    return path
+
+
+@pytest.fixture
+def health_tracker_server(tmp_path):
+    """Local HTTP stand-in for files.training.databricks.com."""
+    served = tmp_path / "served"
+    served.mkdir()
+    for name in [
+        "health_tracker_data_2020_12.json",
+        "health_tracker_data_2021_1.json",
+        "health_tracker_data_2021_1_late.json",
+    ]:
+        (served / name).write_text('{"device_id":0,"heartrate":52.8}\n' * 1000)
+
+    requests = []
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_request(self, code="-", size="-"):
+            requests.append(self.path)
+
+        def log_message(self, format, *args):
+            pass
+
+    handler = functools.partial(Handler, directory=str(served))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/", requests
+    server.shutdown()
+
+
+@pytest.fixture
+def range_server():
+    """HTTP server that honours Range and If-Range against a strong ETag."""
+    state = {"body": b"x" * 1000, "etag": '"v1"', "requests": []}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body, etag = state["body"], state["etag"]
+            state["requests"].append(dict(self.headers))
+            match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+            if match and self.headers.get("If-Range", etag) == etag:
+                start = int(match.group(1))
+                if start >= len(body):
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(body)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+                )
+                body = body[start:]
+            else:
+                self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/file.json", state
+    server.shutdown()
+
+
+def _interrupted_download(cache_dir, url: str, data: bytes, etag: str) -> None:
+    """Leave ``data`` in the cache as a partial download of ``url``."""
+    partial = cache_dir / "partial" / hashlib.sha1(url.encode()).hexdigest()
+    partial.parent.mkdir(parents=True)
+    partial.write_bytes(data)
+    with open(str(partial) + ".validator", "w") as f:
+        json.dump({"etag": etag, "last_modified": None, "length": "1000"}, f)
+
+
+# COMMAND ----------
+
+def test_month_range():
+    assert month_range((2020, 11), (2021, 2)) == [
+        (2020, 11),
+        (2020, 12),
+        (2021, 1),
+        (2021, 2),
+    ]
+
+
+# COMMAND ----------
+
+def test_retrieve_data_range_uses_cache(health_tracker_server, tmp_path, monkeypatch):
+    base_url, requests = health_tracker_server
+    monkeypatch.setattr("utilities.DOWNLOAD_CACHE_DIR", str(tmp_path / "cache") + "/")
+    raw_path = "file:" + str(tmp_path / "raw") + "/"
+
+    first = retrieve_data_range(
+        (2020, 12), (2021, 1), raw_path, include_late=True, base_url=base_url
+    )
+    # December has no late file: it is requested, gets a 404 and is skipped.
+    assert len(first) == 3
+    late_file = tmp_path / "raw" / "late" / "health_tracker_data_2021_1_late.json"
+    assert os.path.exists(late_file)
+    assert not os.path.exists(
+        tmp_path / "raw" / "late" / "health_tracker_data_2020_12_late.json"
+    )
+    assert len(requests) == 4
+
+    second = retrieve_data_range(
+        (2020, 12), (2021, 1), raw_path, include_late=True, base_url=base_url
+    )
+    assert second == first
+    # Cached files are not requested again; only the missing late file is.
+    assert len(requests) == 5
+
+
+# COMMAND ----------
+
+def test_resolve_location_with_local_backend(tmp_path):
+    register_storage_location(
+        "sales",
+        "wasbs://training@account.blob.core.windows.net/sales/",
+        secret_scope="students",
+        secret_key="storageread",
+    )
+    assert resolve_location("sales/2004") == (
+        "wasbs://training@account.blob.core.windows.net/sales/2004"
+    )
+    assert resolve_location("s3a://bucket/output") == "s3a://bucket/output"
+
+    use_local_storage(str(tmp_path))
+    try:
+        assert resolve_location("sales/2004") == f"file:{tmp_path}/sales/2004"
+    finally:
+        use_local_storage(None)
+
+    with pytest.raises(KeyError):
+        resolve_location("unknown/2004")
+
+
+# COMMAND ----------
+
+def test_get_credential_refreshes_after_ttl(monkeypatch):
+    fetched = []
+
+    def fetch(scope, key):
+        fetched.append((scope, key))
+        return f"token-{len(fetched)}"
+
+    now = [1000.0]
+    monkeypatch.setattr("utilities.time.time", lambda: now[0])
+    assert get_credential("students", "ttl-test", fetch=fetch, ttl=60) == "token-1"
+    assert get_credential("students", "ttl-test", fetch=fetch, ttl=60) == "token-1"
+    now[0] += 61
+    assert get_credential("students", "ttl-test", fetch=fetch, ttl=60) == "token-2"
+    assert len(fetched) == 2
+
+
+# COMMAND ----------
+
+def test_read_delta_snapshot_files_keeps_deletion_vector_files(
+    spark_session: SparkSession, deletion_vector_table
+):
+    files = read_delta_snapshot_files(spark_session, deletion_vector_table).collect()
+    live = spark_session.read.format("delta").load(deletion_vector_table).inputFiles()
+    assert sorted(os.path.basename(f.path) for f in files) == sorted(
+        os.path.basename(path) for path in live
+    )
+    assert sum(f.deletedRows for f in files) == 10
+    assert read_delta_tombstones(spark_session, deletion_vector_table).count() == 0
+
+
+# COMMAND ----------
+
+def test_plan_vacuum_keeps_live_deletion_vector_files(
+    spark_session: SparkSession, deletion_vector_table
+):
+    # Both data files and the deletion vector are live: nothing to vacuum.
+    plan = plan_vacuum(spark_session, deletion_vector_table, retention_hours=0)
+    assert plan["files"] == []
+
+    live = {
+        os.path.basename(path)
+        for path in spark_session.read.format("delta")
+        .load(deletion_vector_table)
+        .inputFiles()
+    }
+    spark_session.range(200, 210).write.format("delta").mode("overwrite").save(
+        deletion_vector_table
+    )
+    plan = plan_vacuum(spark_session, deletion_vector_table, retention_hours=0)
+    planned = {os.path.basename(path) for path in plan["files"]}
+    assert live <= planned
+    assert any(name.startswith("deletion_vector_") for name in planned)
+    assert plan["bytes"] > 0
+
+
+def test_plan_vacuum_reads_retention_from_table_properties(
+    spark_session: SparkSession, deletion_vector_table
+):
+    spark_session.sql(
+        f"""
+        ALTER TABLE delta.`{deletion_vector_table}` SET TBLPROPERTIES (
+            'delta.deletedFileRetentionDuration' = 'interval 2 hours'
+        )
+        """
+    )
+    plan = plan_vacuum(spark_session, deletion_vector_table)
+    assert plan["retention_hours"] == 2
+    # Nothing was removed two hours ago, so nothing is eligible yet.
+    assert plan["files"] == []
+
+
+# COMMAND ----------
+
+def test_download_to_cache_resumes_partial_download(range_server, tmp_path):
+    url, state = range_server
+    _interrupted_download(tmp_path, url, state["body"][:400], '"v1"')
+    digest = download_to_cache(url, str(tmp_path))
+    assert digest == hashlib.sha256(state["body"]).hexdigest()
+    assert state["requests"][-1]["Range"] == "bytes=400-"
+    assert state["requests"][-1]["If-Range"] == '"v1"'
+
+
+def test_download_to_cache_completes_full_partial_on_416(range_server, tmp_path):
+    url, state = range_server
+    _interrupted_download(tmp_path, url, state["body"], '"v1"')
+    digest = download_to_cache(url, str(tmp_path))
+    assert digest == hashlib.sha256(state["body"]).hexdigest()
+    assert len(state["requests"]) == 1
+
+
+def test_download_to_cache_restarts_when_remote_changed(range_server, tmp_path):
+    url, state = range_server
+    _interrupted_download(tmp_path, url, state["body"][:400], '"v1"')
+    state["body"], state["etag"] = b"y" * 1200, '"v2"'
+    digest = download_to_cache(url, str(tmp_path))
+    assert digest == hashlib.sha256(b"y" * 1200).hexdigest()
+
+
+# COMMAND ----------
+
+def _age(path, seconds: float = 60) -> None:
+    """Move a file's or directory's modification time into the past."""
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_list_new_raw_files_lists_only_changed_directories(tmp_path, monkeypatch):
+    raw, index = tmp_path / "raw", str(tmp_path / "index" / "listing.json")
+    (raw / "2020-01").mkdir(parents=True)
+    (raw / "2020-02").mkdir()
+    files = [raw / "flat.json", raw / "2020-01" / "a.json", raw / "2020-02" / "b.json"]
+    for path in files:
+        path.write_text("{}\n")
+        _age(path)
+    for directory in [raw / "2020-01", raw / "2020-02", raw]:
+        _age(directory)
+    raw_path = f"file:{raw}/"
+
+    first = list_new_raw_files(raw_path, f"file:{index}")
+    assert sorted(os.path.relpath(path, raw) for path in first) == [
+        os.path.join("2020-01", "a.json"),
+        os.path.join("2020-02", "b.json"),
+        "flat.json",
+    ]
+
+    # Nothing changed, so no directory is listed again.
+    def no_scandir(path):
+        raise AssertionError(f"listed {path}")
+
+    monkeypatch.setattr("utilities.os.scandir", no_scandir)
+    assert list_new_raw_files(raw_path, f"file:{index}") == []
+    monkeypatch.undo()
+
+    (raw / "flat2.json").write_text("{}\n")
+    (raw / "2020-01" / "late.json").write_text("{}\n")
+    # Only the root changed; 2020-01 is older than the newest date prefix.
+    assert list_new_raw_files(raw_path, f"file:{index}") == [str(raw / "flat2.json")]
+
+
+def test_notify_raw_files_keeps_concurrent_notifications(tmp_path):
+    raw, index = tmp_path / "raw", f"file:{tmp_path}/index/listing.json"
+    raw.mkdir()
+    paths = []
+    for i in range(20):
+        (raw / f"{i}.json").write_text("{}\n")
+        paths.append(f"file:{raw}/{i}.json")
+
+    threads = [
+        threading.Thread(target=notify_raw_files, args=(index, [path]))
+        for path in paths
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(list_new_raw_files(f"file:{raw}/", index)) == 20
+    assert list_new_raw_files(f"file:{raw}/", index) == []
+
+
+# COMMAND ----------
+
+def test_table_statistics_applies_deletion_vectors(
+    spark_session: SparkSession, deletion_vector_table
+):
+    statistics = table_statistics(spark_session, deletion_vector_table)
+    assert statistics["num_records"] == 90
+    assert statistics["files_scanned"] == 1
+    assert statistics["columns"]["id"] == {"min": 10, "max": 99, "null_count": 0}
+    assert table_row_count(spark_session, deletion_vector_table) == 90
+
+
+def test_table_statistics_scans_unindexed_and_truncated_columns(
+    spark_session: SparkSession, tmp_path
+):
+    path = str(tmp_path / "stats_table")
+    spark_session.sql(
+        f"""
+        CREATE TABLE delta.`{path}` (id LONG, label STRING, note STRING)
+        USING DELTA
+        TBLPROPERTIES ('delta.dataSkippingNumIndexedCols' = '2')
+        """
+    )
+    long_value = "z" * 40
+    spark_session.createDataFrame(
+        [(1, "a" * 40, None), (2, long_value, "late"), (3, None, "early")],
+        "id LONG, label STRING, note STRING",
+    ).write.format("delta").mode("append").save(path)
+
+    statistics = table_statistics(spark_session, path)
+    assert statistics["files_scanned"] == 0
+    assert sorted(statistics["columns_scanned"]) == ["label", "note"]
+    assert statistics["columns"]["id"] == {"min": 1, "max": 3, "null_count": 0}
+    assert statistics["columns"]["label"] == {
+        "min": "a" * 40,
+        "max": long_value,
+        "null_count": 1,
+    }
+    assert statistics["columns"]["note"] == {
+        "min": "early",
+        "max": "late",
+        "null_count": 1,
+    }
+
+
+# COMMAND ----------
+
+def test_read_delta_snapshot_sees_recreated_table(
+    spark_session: SparkSession, tmp_path
+):
+    path = str(tmp_path / "recreated")
+    spark_session.range(0, 5).write.format("delta").save(path)
+    spark_session.range(5, 10).write.format("delta").mode("append").save(path)
+    assert read_delta_snapshot(spark_session, path).count() == 10
+
+    shutil.rmtree(path)
+    spark_session.range(0, 3).write.format("delta").save(path)
+    assert read_delta_snapshot(spark_session, path).count() == 3
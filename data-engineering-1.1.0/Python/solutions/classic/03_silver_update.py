@@ -125,7 +125,8 @@ dbutils.fs.rm(rawPath, recurse=True)
 # COMMAND ----------
 
 bronzeDF = read_batch_bronze(spark)
-transformedBronzeDF = transform_bronze(bronzeDF)
+# Cached so both writes and both status updates see the same rows.
+transformedBronzeDF = transform_bronze(bronzeDF).cache()
 
 (silverCleanDF, silverQuarantineDF) = generate_clean_and_quarantine_dataframes(
     transformedBronzeDF
@@ -138,6 +139,7 @@ bronzeToSilverWriter.save(silverPath)
 
 update_bronze_table_status(spark, bronzePath, silverCleanDF, "loaded")
 update_bronze_table_status(spark, bronzePath, silverQuarantineDF, "quarantined")
+transformedBronzeDF.unpersist()
 
 # COMMAND ----------
 
@@ -15,6 +15,9 @@ classicPipelinePath = f"/dbacademy/{username}/dataengineering/classic/"
 
 landingPath = classicPipelinePath + "landing/"
 rawPath = classicPipelinePath + "raw/"
+rawArchivePath = classicPipelinePath + "rawArchive/"
+piiKeyStorePath = classicPipelinePath + "piiKeyStore/"
+deletionAuditPath = classicPipelinePath + "deletionAudit/"
 bronzePath = classicPipelinePath + "bronze/"
 silverPath = classicPipelinePath + "silver/"
 silverQuarantinePath = classicPipelinePath + "silverQuarantine/"
@@ -1,22 +1,38 @@
 # Databricks notebook source
 
 from delta.tables import DeltaTable
-from pyspark.sql import DataFrame
+from pyspark.sql import Column, DataFrame
 from pyspark.sql.functions import (
+    broadcast,
+    coalesce,
     col,
+    count,
+    countDistinct,
     current_timestamp,
+    date_trunc,
+    expr,
     from_json,
     from_unixtime,
+    input_file_name,
     lag,
     lead,
     lit,
     mean,
+    split,
     stddev,
     max,
+    sum as sum_,
+    to_json,
+    when,
 )
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List
 from pyspark.sql.session import SparkSession
 from pyspark.sql.window import Window
+import json
+import secrets
+import uuid
 
 # COMMAND ----------
 
@@ -25,25 +41,248 @@ def batch_writer(
     partition_column: str,
     exclude_columns: List = [],
     mode: str = "append",
+    granularity: str = "day",
+    replace_where: str = None,
 ) -> DataFrame:
-    return (
+    """Batch Delta writer.
+
+    ``mode="replace_partitions"`` reprocesses in place: the write atomically
+    replaces only the dates present in ``dataframe`` (or the rows matched by
+    ``replace_where``) and Delta rejects rows falling outside that predicate.
+    The predicate is on the date column itself, not the week or month
+    partition derived from it, so replacing one day of a weekly or monthly
+    layout leaves the other days of that partition in place. The rest of the
+    table stays queryable and untouched throughout.
+    """
+    replace_predicate = None
+    if mode == "replace_partitions":
+        replace_predicate = replace_where
+        if replace_predicate is None:
+            replace_predicate = partition_predicate(dataframe, partition_column)
+        mode = "overwrite"
+
+    dataframe, partition_column = with_partition_granularity(
+        dataframe, partition_column, granularity
+    )
+
+    writer = (
         dataframe.drop(
             *exclude_columns
         )  # This uses Python argument unpacking (https://docs.python.org/3/tutorial/controlflow.html#unpacking-argument-lists)
         .write.format("delta")
         .mode(mode)
-        .partitionBy(partition_column)
     )
+    if replace_predicate is not None:
+        writer = writer.option("replaceWhere", replace_predicate)
+    if partition_column is not None:
+        writer = writer.partitionBy(partition_column)
+    return writer
+
+
+def partition_predicate(dataframe: DataFrame, partition_column: str) -> str:
+    """SQL predicate matching exactly the values of ``partition_column`` present."""
+    if partition_column is None:
+        raise ValueError("Replacing partitions requires a partition column")
+    values = [
+        row[0] for row in dataframe.select(partition_column).distinct().collect()
+    ]
+    value_list = ", ".join(f"'{value}'" for value in values if value is not None)
+    predicate = f"{partition_column} IN ({value_list})" if value_list else "1 = 0"
+    if None in values:
+        predicate = f"({predicate}) OR {partition_column} IS NULL"
+    return predicate
+
+
+def rewrite_partition_layout(
+    spark: SparkSession, deltaPath: str, partition_column: str, granularity: str
+) -> bool:
+    """Rewrite a table into a new partition layout in a single atomic overwrite.
+
+    Readers keep using the previous snapshot until the overwrite commits.
+    Streams writing to the table must be stopped and restarted with the same
+    granularity, since the partition columns change. Week or month columns
+    derived by a previous layout are dropped from the rewritten table.
+    """
+    snapshotDF = spark.read.format("delta").load(deltaPath)
+    if partition_column is not None:
+        stale_columns = [
+            derived_partition_column(partition_column, candidate)
+            for candidate in ("week", "month")
+            if candidate != granularity
+        ]
+        snapshotDF = snapshotDF.drop(*stale_columns)
+    (
+        batch_writer(
+            snapshotDF, partition_column, mode="overwrite", granularity=granularity
+        )
+        .option("overwriteSchema", "true")
+        .save(deltaPath)
+    )
+    return True
+
+
+# COMMAND ----------
+
+def with_partition_granularity(
+    dataframe: DataFrame, partition_column: str, granularity: str = "day"
+) -> (DataFrame, str):
+    """Derive the partition column for a day, week, month or "none" layout.
+
+    Week and month layouts add a column truncating the date partition column,
+    e.g. p_eventdate -> p_eventweek; "none" leaves the data unpartitioned.
+    """
+    if granularity == "day" or partition_column is None:
+        return dataframe, partition_column
+    if granularity == "none":
+        return dataframe, None
+    if granularity not in ("week", "month"):
+        raise ValueError(f"Unknown partition granularity: {granularity}")
+
+    derived_column = derived_partition_column(partition_column, granularity)
+    return (
+        dataframe.withColumn(
+            derived_column,
+            date_trunc(granularity, col(partition_column)).cast("date"),
+        ),
+        derived_column,
+    )
+
+
+def derived_partition_column(partition_column: str, granularity: str) -> str:
+    """Name of the week or month column derived from a date partition column."""
+    if "date" in partition_column:
+        return partition_column.replace("date", granularity)
+    return f"{partition_column}_{granularity}"
+
+
+# COMMAND ----------
+
+# Declarative data-quality rules, keyed by the table the rows are headed for.
+# Supported rule types:
+#   not_null     {"column"}
+#   range        {"column", "min" and/or "max"}
+#   regex        {"column", "pattern"}
+#   referential  {"column", "values"} or {"column", "table", "reference_column"}
+#   freshness    {"column", "max_age"}  e.g. "30 days"
+QUALITY_RULES = {
+    "health_tracker_classic_silver": [
+        {"name": "device_id_not_null", "type": "not_null", "column": "device_id"},
+    ],
+}
+
+
+def compile_quality_rule(rule: Dict, matched: Column = None) -> Column:
+    """Return a boolean Column that is true when a row passes the rule.
+
+    A table-backed referential rule needs ``matched``, the flag column that
+    evaluate_quality_rules joins in from the reference table.
+    """
+    column = col(rule["column"])
+    rule_type = rule["type"]
+
+    if rule_type == "not_null":
+        passes = column.isNotNull()
+    elif rule_type == "range":
+        passes = lit(True)
+        if rule.get("min") is not None:
+            passes = passes & (column >= lit(rule["min"]))
+        if rule.get("max") is not None:
+            passes = passes & (column <= lit(rule["max"]))
+    elif rule_type == "regex":
+        passes = column.rlike(rule["pattern"])
+    elif rule_type == "referential":
+        if rule.get("values") is not None:
+            passes = column.isin(list(rule["values"]))
+        elif matched is not None:
+            passes = matched
+        else:
+            raise ValueError(
+                f"Rule {rule['name']} reads {rule['table']}; "
+                "evaluate it with evaluate_quality_rules"
+            )
+    elif rule_type == "freshness":
+        passes = column >= current_timestamp() - expr(f"INTERVAL {rule['max_age']}")
+    else:
+        raise ValueError(f"Unknown quality rule type: {rule_type}")
+
+    # A rule that cannot be evaluated (null input) counts as a failure.
+    return coalesce(passes, lit(False))
+
+
+def evaluate_quality_rules(
+    dataframe: DataFrame, rules: List[Dict], mask_column: str = "quality_mask"
+) -> DataFrame:
+    """Add a bitmask column where bit i is set when the row fails rules[i].
+
+    All rules are compiled into a single projection so the input is read once.
+    A referential rule backed by a table is checked with a broadcast join
+    against the table's distinct keys rather than a literal IN list.
+    """
+    if len(rules) > 63:
+        raise ValueError("At most 63 quality rules fit in the bitmask")
+
+    mask = lit(0).cast("long")
+    flags = []
+    for bit, rule in enumerate(rules):
+        matched = None
+        if rule["type"] == "referential" and rule.get("values") is None:
+            flag = f"_{mask_column}_reference_{bit}"
+            reference = (
+                dataframe.sparkSession.read.table(rule["table"])
+                .select(col(rule.get("reference_column", rule["column"])).alias(flag))
+                .distinct()
+            )
+            dataframe = dataframe.join(
+                broadcast(reference), col(rule["column"]) == reference[flag], "left"
+            )
+            matched = col(flag).isNotNull()
+            flags.append(flag)
+        failed = ~compile_quality_rule(rule, matched)
+        mask = mask + when(failed, lit(1 << bit)).otherwise(0)
+    return dataframe.withColumn(mask_column, mask).drop(*flags)
+
+
+def quality_rule_counters(
+    rules: List[Dict], mask_column: str = "quality_mask"
+) -> List[Column]:
+    """Failure count per rule, plus totals, computed from the bitmask column."""
+    failures = [
+        count(when(col(mask_column).bitwiseAND(1 << bit) != 0, 1)).alias(rule["name"])
+        for bit, rule in enumerate(rules)
+    ]
+    return [
+        count(lit(1)).alias("rows_evaluated"),
+        count(when(col(mask_column) != 0, 1)).alias("rows_quarantined"),
+        *failures,
+    ]
 
 
 # COMMAND ----------
 
 def generate_clean_and_quarantine_dataframes(
     dataframe: DataFrame,
+    rules: List[Dict] = None,
+    observation=None,
 ) -> (DataFrame, DataFrame):
+    """Split a DataFrame into rows passing every quality rule and rows to quarantine.
+
+    The quarantine DataFrame keeps the ``quality_mask`` column so the failing
+    rules can be traced. Pass an ``Observation`` (or a name, for streams) to
+    collect the per-rule counters in the same pass that writes the batch.
+
+    Nothing is cached here. When both outputs are written, cache
+    ``dataframe`` first and unpersist it once both writes have finished.
+    """
+    if rules is None:
+        rules = QUALITY_RULES["health_tracker_classic_silver"]
+
+    evaluated = evaluate_quality_rules(dataframe, rules)
+    if observation is not None:
+        evaluated = evaluated.observe(observation, *quality_rule_counters(rules))
+
     return (
-        dataframe.filter("device_id IS NOT NULL"),
-        dataframe.filter("device_id IS NULL"),
+        evaluated.filter("quality_mask = 0").drop("quality_mask"),
+        evaluated.filter("quality_mask != 0"),
     )
 
 
@@ -112,12 +351,15 @@ def transform_bronze(bronze: DataFrame, quarantine: bool = False) -> DataFrame:
 # COMMAND ----------
 
 def repair_quarantined_records(
-    spark: SparkSession, bronzeTable: str, userTable: str
+    spark: SparkSession, bronzeTable: str, userTable: str, keyStorePath: str = None
 ) -> DataFrame:
     bronzeQuarantinedDF = spark.read.table(bronzeTable).filter("status = 'quarantined'")
-    bronzeQuarTransDF = transform_bronze(bronzeQuarantinedDF, quarantine=True).alias(
-        "quarantine"
-    )
+    bronzeQuarTransDF = transform_bronze(bronzeQuarantinedDF, quarantine=True)
+    if keyStorePath is not None:
+        bronzeQuarTransDF = decrypt_pii(
+            spark, bronzeQuarTransDF, keyStorePath, columns=["device_id"]
+        )
+    bronzeQuarTransDF = bronzeQuarTransDF.alias("quarantine")
     health_tracker_user_df = spark.read.table(userTable).alias("user")
     repairDF = bronzeQuarTransDF.join(
         health_tracker_user_df,
@@ -152,7 +394,7 @@ def update_bronze_table_status(
     spark: SparkSession, bronzeTablePath: str, dataframe: DataFrame, status: str
 ) -> bool:
 
-    bronzeTable = DeltaTable.forPath(spark, bronzePath)
+    bronzeTable = delta_table(spark, bronzeTablePath)
     dataframeAugmented = dataframe.withColumn("status", lit(status))
 
     update_match = "bronze.value = dataframe.value"
@@ -166,3 +408,486 @@ def update_bronze_table_status(
     )
 
     return True
+
+
+# COMMAND ----------
+
+# Crypto-shredding. PII in the raw JSON (``name``, and a ``device_id`` that
+# carries a user_id) is encrypted at ingest with a per-user data key from a
+# Delta key store. Ciphertexts are stored as "<key_id>:<base64>" so the key
+# can be found without revealing the user. Deleting a user only destroys
+# their key; rows left undecryptable are dropped later by
+# ``purge_shredded_records`` as part of the regular compaction job.
+# Encryption and decryption use Spark's native ``aes_encrypt``/``aes_decrypt``
+# over a broadcast key join, so there is no Python UDF on the ingest path.
+
+PII_KEY_STORE_SCHEMA = """
+    key_id STRING,
+    user_id STRING,
+    data_key BINARY,
+    created_at TIMESTAMP
+"""
+
+RAW_PII_SCHEMA = """
+    time STRING,
+    name STRING,
+    device_id STRING,
+    steps INTEGER,
+    day INTEGER,
+    month INTEGER,
+    hour INTEGER
+"""
+
+USER_ID_PATTERN = r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+
+
+def pii_key_id(ciphertext: Column) -> Column:
+    return when(ciphertext.contains(":"), split(ciphertext, ":").getItem(0))
+
+
+def _encrypt(plaintext: str) -> Column:
+    """Encrypt the SQL expression ``plaintext`` with the joined ``data_key``."""
+    return expr(
+        f"CASE WHEN {plaintext} IS NULL OR key_id IS NULL THEN {plaintext} "
+        f"ELSE concat(key_id, ':', base64(aes_encrypt({plaintext}, data_key, 'GCM'))) "
+        "END"
+    )
+
+
+def _read_key_store(spark: SparkSession, keyStorePath: str) -> DataFrame:
+    # Deletion vectors stay off: a key deleted through one would remain in an
+    # active data file, where no VACUUM can reach it.
+    if not DeltaTable.isDeltaTable(spark, keyStorePath):
+        (
+            spark.createDataFrame([], PII_KEY_STORE_SCHEMA)
+            .write.format("delta")
+            .mode("ignore")
+            .save(keyStorePath)
+        )
+        spark.sql(
+            f"ALTER TABLE delta.`{keyStorePath}` "
+            "SET TBLPROPERTIES ('delta.enableDeletionVectors' = false)"
+        )
+    return spark.read.format("delta").load(keyStorePath)
+
+
+def ensure_pii_keys(
+    spark: SparkSession, keyStorePath: str, user_ids: DataFrame
+) -> DataFrame:
+    """Create data keys for users that have none and return the key store.
+
+    Keys are generated on the driver from ``secrets``; only users new to the
+    store are collected. The insert is a merge, so concurrent ingests agree
+    on a single key per user.
+    """
+    keyStore = _read_key_store(spark, keyStorePath)
+    new_users = [
+        row.user_id
+        for row in user_ids.where(col("user_id").isNotNull())
+        .select("user_id")
+        .distinct()
+        .join(keyStore, "user_id", "left_anti")
+        .collect()
+    ]
+    if new_users:
+        created_at = datetime.now(timezone.utc)
+        newKeysDF = spark.createDataFrame(
+            [
+                (str(uuid.uuid4()), user_id, secrets.token_bytes(32), created_at)
+                for user_id in new_users
+            ],
+            PII_KEY_STORE_SCHEMA,
+        )
+        (
+            DeltaTable.forPath(spark, keyStorePath)
+            .alias("keys")
+            .merge(newKeysDF.alias("new"), "keys.user_id = new.user_id")
+            .whenNotMatchedInsertAll()
+            .execute()
+        )
+    return spark.read.format("delta").load(keyStorePath)
+
+
+def encrypt_pii(
+    spark: SparkSession, raw: DataFrame, keyStorePath: str, userTable: str
+) -> DataFrame:
+    """Encrypt the PII fields inside the raw ``value`` JSON.
+
+    The user is resolved from ``device_id`` through ``userTable``, or taken
+    from ``device_id`` itself when it holds a user_id. Records whose user
+    cannot be resolved are passed through unchanged.
+    """
+    users = spark.read.table(userTable).select(
+        col("user_id").alias("_user_id"),
+        col("device_id").cast("string").alias("_device_id"),
+    )
+    payload = col("_payload")
+    resolvedDF = (
+        raw.withColumn("_payload", from_json(col("value"), RAW_PII_SCHEMA))
+        .join(broadcast(users), payload.device_id == col("_device_id"), "left")
+        .withColumn(
+            "user_id",
+            coalesce(
+                col("_user_id"),
+                when(payload.device_id.rlike(USER_ID_PATTERN), payload.device_id),
+            ),
+        )
+    )
+    keys = ensure_pii_keys(spark, keyStorePath, resolvedDF).select(
+        "user_id", "key_id", "data_key"
+    )
+    encryptedDF = resolvedDF.join(broadcast(keys), "user_id", "left").withColumn(
+        "_payload",
+        payload.withField("name", _encrypt("_payload.name")).withField(
+            "device_id",
+            when(
+                payload.device_id == col("user_id"), _encrypt("_payload.device_id")
+            ).otherwise(payload.device_id),
+        ),
+    )
+    return encryptedDF.withColumn(
+        "value", when(col("key_id").isNull(), col("value")).otherwise(to_json(payload))
+    ).select(*raw.columns)
+
+
+def decrypt_pii(
+    spark: SparkSession,
+    dataframe: DataFrame,
+    keyStorePath: str,
+    columns: List[str] = ["name"],
+) -> DataFrame:
+    """Decrypt ciphertext columns; values whose key was shredded become null."""
+    keys = _read_key_store(spark, keyStorePath).select("key_id", "data_key")
+    for column in columns:
+        key_id, data_key = f"_{column}_key_id", f"_{column}_data_key"
+        dataframe = (
+            dataframe.join(
+                broadcast(keys.toDF(key_id, data_key)),
+                pii_key_id(col(column)) == col(key_id),
+                "left",
+            )
+            .withColumn(
+                column,
+                when(pii_key_id(col(column)).isNull(), col(column)).otherwise(
+                    expr(
+                        f"CAST(aes_decrypt(unbase64(split({column}, ':')[1]), "
+                        f"{data_key}, 'GCM') AS STRING)"
+                    )
+                ),
+            )
+            .drop(key_id, data_key)
+        )
+    return dataframe
+
+
+def shred_pii_keys(
+    spark: SparkSession, keyStorePath: str, deletions: DataFrame
+) -> int:
+    """Destroy the data keys of the users in ``deletions`` (a ``user_id`` column).
+
+    Any deletion vectors are purged and the key store's history is vacuumed
+    straight away, so the keys can't be recovered from a data file or by
+    time travel. Returns the number of keys destroyed.
+    """
+    _read_key_store(spark, keyStorePath)
+    keyStore = DeltaTable.forPath(spark, keyStorePath)
+    (
+        keyStore.alias("keys")
+        .merge(
+            deletions.select("user_id").distinct().alias("deletions"),
+            "keys.user_id = deletions.user_id",
+        )
+        .whenMatchedDelete()
+        .execute()
+    )
+    metrics = keyStore.history(1).select("operationMetrics").first()[0]
+    destroyed = int(metrics.get("numTargetRowsDeleted", 0))
+    if not destroyed:
+        return 0
+
+    # A store created before deletion vectors were disabled may still carry
+    # them; the purge rewrites those files so the old ones become tombstones.
+    spark.sql(f"REORG TABLE delta.`{keyStorePath}` APPLY (PURGE)")
+    plan = plan_vacuum(spark, keyStorePath, retention_hours=0)
+    report = execute_vacuum(spark, plan, dry_run=False)
+    if not plan["files"] or report["deleted"] < len(plan["files"]):
+        raise RuntimeError(
+            f"Shredding left key material in {keyStorePath}: "
+            f"{report.get('deleted', 0)} of {len(plan['files'])} files removed"
+        )
+    return destroyed
+
+
+def purge_shredded_records(
+    spark: SparkSession, deltaPath: str, ciphertext: Column, keyStorePath: str
+) -> None:
+    """Physically delete rows whose data key has been shredded.
+
+    ``ciphertext`` locates the encrypted value in the table, e.g.
+    ``col("name")`` for silver or ``get_json_object(col("value"), "$.name")``
+    for bronze. Meant to run alongside the regular OPTIMIZE cycle.
+    """
+    keys = _read_key_store(spark, keyStorePath).select("key_id")
+    orphanedDF = (
+        spark.read.format("delta")
+        .load(deltaPath)
+        .select(pii_key_id(ciphertext).alias("key_id"))
+        .where(col("key_id").isNotNull())
+        .distinct()
+        .join(keys, "key_id", "left_anti")
+    )
+    condition = pii_key_id(ciphertext) == col("orphaned.key_id")
+    (
+        DeltaTable.forPath(spark, deltaPath)
+        .alias("target")
+        .merge(orphanedDF.alias("orphaned"), condition)
+        .whenMatchedDelete()
+        .execute()
+    )
+
+
+# COMMAND ----------
+
+# Soft deletes. Once deletion vectors are enabled, DELETE and MERGE ... DELETE
+# record the positions of the removed rows in a small bitmap file beside each
+# affected data file instead of rewriting it, and Delta readers, batch and
+# streaming, filter on those bitmaps. purge_soft_deletes folds them into
+# physical rewrites later, off-peak, one REORG per batch of partitions.
+SOFT_DELETE_PURGE_FRACTION = 0.05
+SOFT_DELETE_PURGE_BATCH = 32
+
+
+def enable_soft_deletes(spark: SparkSession, deltaPath: str) -> None:
+    properties = DeltaTable.forPath(spark, deltaPath).detail().first().properties
+    if properties.get("delta.enableDeletionVectors") != "true":
+        spark.sql(
+            f"ALTER TABLE delta.`{deltaPath}` "
+            "SET TBLPROPERTIES ('delta.enableDeletionVectors' = true)"
+        )
+
+
+def soft_delete(spark: SparkSession, deltaPath: str, condition: str) -> int:
+    """Delete the rows matching ``condition`` without rewriting data files.
+
+    Returns the number of rows deleted.
+    """
+    enable_soft_deletes(spark, deltaPath)
+    deltaTable = DeltaTable.forPath(spark, deltaPath)
+    deltaTable.delete(condition)
+    metrics = deltaTable.history(1).select("operationMetrics").first()[0]
+    return int(metrics.get("numDeletedRows", 0))
+
+
+def _partition_values_predicate(partition_values: Dict) -> str:
+    return " AND ".join(
+        f"`{name}` IS NULL" if value is None else f"`{name}` = '{value}'"
+        for name, value in sorted(partition_values.items())
+    )
+
+
+def purge_soft_deletes(
+    spark: SparkSession,
+    deltaPath: str,
+    min_deleted_fraction: float = SOFT_DELETE_PURGE_FRACTION,
+    batch_size: int = SOFT_DELETE_PURGE_BATCH,
+) -> List[str]:
+    """Physically rewrite partitions whose soft-deleted share is high enough.
+
+    Candidate partitions come from the deletion vectors in the Delta log, and
+    up to ``batch_size`` of them are purged per REORG. Returns the partition
+    predicates that were purged.
+    """
+    partitions = (
+        read_delta_snapshot_files(spark, deltaPath)
+        .groupBy(to_json(col("partitionValues")).alias("partitionValues"))
+        .agg(
+            sum_("deletedRows").alias("deleted_rows"),
+            sum_("stats.numRecords").alias("num_records"),
+        )
+        .where(col("deleted_rows") > 0)
+        .where(
+            col("num_records").isNull()
+            | (col("deleted_rows") >= col("num_records") * min_deleted_fraction)
+        )
+        .collect()
+    )
+    predicates = [
+        _partition_values_predicate(json.loads(row.partitionValues or "{}"))
+        for row in partitions
+    ]
+
+    for start in range(0, len(predicates), batch_size):
+        batch = predicates[start : start + batch_size]
+        where = ""
+        if all(batch):
+            where = "WHERE " + " OR ".join(f"({predicate})" for predicate in batch)
+        spark.sql(f"REORG TABLE delta.`{deltaPath}` {where} APPLY (PURGE)")
+        if not where:
+            break
+    return predicates
+
+
+# COMMAND ----------
+
+# Deletion queue. Pending requests are the user_ids in the requests table
+# without an audit record yet. They are resolved to device_ids once, then
+# every target table is swept in parallel: a pre-scan finds the affected
+# partitions and per-request counts, and a single MERGE per table deletes
+# all matches, restricted to those partitions. ``key`` is the SQL
+# expression on the target matched against the resolved keys; bronze is
+# matched on the device_id in its JSON, which holds either a device_id or,
+# for quarantined records, the user_id itself.
+DELETION_TARGETS = [
+    {
+        "table": "health_tracker_classic_bronze",
+        "key": "get_json_object(value, '$.device_id')",
+        "partition_column": "p_ingestdate",
+        "keys": ["device_id", "user_id"],
+    },
+    {
+        "table": "health_tracker_classic_silver",
+        "key": "CAST(device_id AS STRING)",
+        "partition_column": "p_eventdate",
+        "keys": ["device_id"],
+    },
+    {
+        "table": "health_tracker_user",
+        "key": "user_id",
+        "partition_column": None,
+        "keys": ["user_id"],
+    },
+]
+
+DELETION_AUDIT_SCHEMA = """
+    user_id STRING,
+    table_name STRING,
+    rows_deleted LONG,
+    files_touched LONG,
+    processed_at TIMESTAMP
+"""
+
+
+def pending_deletion_requests(
+    spark: SparkSession, requestsTable: str, auditPath: str
+) -> DataFrame:
+    requestsDF = spark.read.table(requestsTable).select("user_id").distinct()
+    if not DeltaTable.isDeltaTable(spark, auditPath):
+        return requestsDF
+    return requestsDF.join(
+        spark.read.format("delta").load(auditPath).select("user_id"),
+        "user_id",
+        "left_anti",
+    )
+
+
+def _delete_matching_rows(
+    spark: SparkSession, target: Dict, keysDF: DataFrame, requests: List[str]
+) -> List[Dict]:
+    """Delete rows of ``target`` matching ``keysDF`` and count them per user."""
+    keysDF = keysDF.where(col("key_type").isin(target["keys"])).select(
+        "user_id", "_key"
+    )
+    partition_column = target["partition_column"]
+    partition_columns = [partition_column] if partition_column else []
+    matchedDF = (
+        spark.read.table(target["table"])
+        .select(
+            expr(target["key"]).alias("_key"),
+            input_file_name().alias("_file"),
+            *partition_columns,
+        )
+        .join(broadcast(keysDF), "_key")
+        .cache()
+    )
+    counts = {
+        row.user_id: row
+        for row in matchedDF.groupBy("user_id")
+        .agg(count(lit(1)).alias("rows"), countDistinct("_file").alias("files"))
+        .collect()
+    }
+
+    if counts:
+        condition = f"{target['key']} = requests._key"
+        if partition_column:
+            values = ", ".join(
+                f"'{row[0]}'"
+                for row in matchedDF.select(partition_column).distinct().collect()
+            )
+            condition += f" AND target.{partition_column} IN ({values})"
+        (
+            DeltaTable.forName(spark, target["table"])
+            .alias("target")
+            .merge(keysDF.select("_key").distinct().alias("requests"), condition)
+            .whenMatchedDelete()
+            .execute()
+        )
+    matchedDF.unpersist()
+
+    return [
+        {
+            "user_id": user_id,
+            "table_name": target["table"],
+            "rows_deleted": counts[user_id].rows if user_id in counts else 0,
+            "files_touched": counts[user_id].files if user_id in counts else 0,
+        }
+        for user_id in requests
+    ]
+
+
+def process_deletion_requests(
+    spark: SparkSession,
+    requestsTable: str,
+    userTable: str,
+    auditPath: str,
+    targets: List[Dict] = DELETION_TARGETS,
+    max_workers: int = 4,
+) -> DataFrame:
+    """Delete every pending request from all target tables in one sweep.
+
+    Writes one audit record per request and table, with the rows deleted and
+    the files they lived in, and returns this run's audit records.
+    """
+    requests = [
+        row.user_id
+        for row in pending_deletion_requests(spark, requestsTable, auditPath).collect()
+    ]
+    if not requests:
+        return spark.createDataFrame([], DELETION_AUDIT_SCHEMA)
+
+    requestsDF = spark.createDataFrame(
+        [(user_id,) for user_id in requests], "user_id STRING"
+    )
+    devices = (
+        spark.read.table(userTable)
+        .join(broadcast(requestsDF), "user_id")
+        .select("user_id", col("device_id").cast("string").alias("device_id"))
+        .collect()
+    )
+    keys = [(user_id, user_id, "user_id") for user_id in requests] + [
+        (row.user_id, row.device_id, "device_id") for row in devices
+    ]
+    keysDF = spark.createDataFrame(keys, "user_id STRING, _key STRING, key_type STRING")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda target: _delete_matching_rows(spark, target, keysDF, requests),
+            targets,
+        )
+        records = [record for result in results for record in result]
+
+    processed_at = datetime.now(timezone.utc)
+    auditDF = spark.createDataFrame(
+        [
+            (
+                record["user_id"],
+                record["table_name"],
+                record["rows_deleted"],
+                record["files_touched"],
+                processed_at,
+            )
+            for record in records
+        ],
+        DELETION_AUDIT_SCHEMA,
+    )
+    auditDF.write.format("delta").mode("append").save(auditPath)
+    return auditDF
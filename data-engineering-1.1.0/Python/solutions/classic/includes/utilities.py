@@ -1,29 +1,225 @@
 # Databricks notebook source
 
+from pyspark.sql import Column, DataFrame
 from pyspark.sql.session import SparkSession
-from urllib.request import urlretrieve
-from pyspark.sql.functions import from_unixtime, dayofmonth, month, hour
+from pyspark.sql.functions import (
+    ceil,
+    coalesce,
+    col,
+    concat,
+    count,
+    dayofmonth,
+    from_json,
+    greatest,
+    from_unixtime,
+    get_json_object,
+    hour,
+    input_file_name,
+    length,
+    lit,
+    max as max_,
+    min as min_,
+    month,
+    regexp_extract,
+    row_number,
+    struct,
+    sum as sum_,
+    to_json,
+    unix_timestamp,
+    when,
+)
+from pyspark.sql.types import StructField, StructType
+from pyspark.sql.window import Window
 from delta import DeltaTable
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
 import time
 
 CLASSIC_DATA = "classic_data_2020_h1.snappy.parquet"
 CLASSIC_DELTA = "classic_data_2020_h1.delta"
+BASE_URL = "https://files.training.databricks.com/static/data/health-tracker/"
 
 # COMMAND ----------
 
-def retrieve_data(file: str, landingPath: str) -> bool:
-    """Download file from remote location to driver. Move from driver to DBFS."""
+def retrieve_data(file: str, landingPath: str, base_url: str = BASE_URL) -> bool:
+    """Download file from remote location, through the driver's cache, to DBFS."""
 
-    base_url = "https://files.training.databricks.com/static/data/health-tracker/"
-    url = base_url + file
-    driverPath = "file:/databricks/driver/" + file
-    dbfsPath = landingPath + file
-    urlretrieve(url, file)
-    dbutils.fs.mv(driverPath, dbfsPath)
+    fetch_files({landingPath + file: base_url + file})
     return True
 
 
+
+# COMMAND ----------
+
+# Downloads go through a content-addressed cache on the driver's local disk:
+# objects/<sha256> holds each file once, refs/<sha1(url)> maps a URL to its
+# digest, and partial/ keeps interrupted downloads so they resume with an
+# HTTP Range request instead of starting over.
+DOWNLOAD_CACHE_DIR = "/tmp/health_tracker_cache/"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _local_path(path: str) -> str:
+    """Driver-local path for a DBFS or ``file:`` path."""
+    if path.startswith("file:"):
+        return path[len("file:") :]
+    if path.startswith("dbfs:"):
+        path = path[len("dbfs:") :]
+    return "/dbfs" + path
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _if_range(validator: Dict) -> str:
+    """A validator for If-Range: a strong ETag, else Last-Modified."""
+    etag = validator.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validator.get("last_modified")
+
+
+def _content_range(headers) -> Tuple[int, int]:
+    """(first byte, total length) from a Content-Range header; None if unknown."""
+    match = re.match(r"bytes (\d+|\*)-?\d*/(\d+|\*)", headers.get("Content-Range", ""))
+    if not match:
+        return None, None
+    first, total = match.groups()
+    return (
+        int(first) if first.isdigit() else None,
+        int(total) if total.isdigit() else None,
+    )
+
+
+def download_to_cache(url: str, cache_dir: str = None) -> str:
+    """Fetch ``url`` into the cache, resuming a partial download; return the digest.
+
+    A partial download resumes only with an If-Range validator (ETag or
+    Last-Modified) saved from the response that started it, so a file that
+    changed on the server is fetched again whole rather than spliced.
+    """
+    cache_dir = cache_dir or DOWNLOAD_CACHE_DIR
+    url_key = hashlib.sha1(url.encode()).hexdigest()
+    ref = os.path.join(cache_dir, "refs", url_key)
+    for directory in ("refs", "objects", "partial"):
+        os.makedirs(os.path.join(cache_dir, directory), exist_ok=True)
+
+    if os.path.exists(ref):
+        with open(ref) as f:
+            digest = f.read().strip()
+        cached = os.path.join(cache_dir, "objects", digest)
+        if os.path.exists(cached) and _file_digest(cached) == digest:
+            return digest
+
+    partial = os.path.join(cache_dir, "partial", url_key)
+    validator_path = partial + ".validator"
+    validator = {}
+    if os.path.exists(partial) and os.path.exists(validator_path):
+        with open(validator_path) as f:
+            validator = json.load(f)
+    if_range = _if_range(validator)
+    offset = os.path.getsize(partial) if if_range else 0
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+        request.add_header("If-Range", if_range)
+
+    try:
+        with urlopen(request) as response:
+            # A 200 means the server ignored the Range or the file changed.
+            append = (
+                offset
+                and response.status == 206
+                and _content_range(response.headers)[0] == offset
+            )
+            if not append:
+                with open(validator_path, "w") as f:
+                    json.dump(
+                        {
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "length": response.headers.get("Content-Length"),
+                        },
+                        f,
+                    )
+            with open(partial, "ab" if append else "wb") as f:
+                shutil.copyfileobj(response, f, DOWNLOAD_CHUNK_SIZE)
+    except HTTPError as error:
+        if error.code != 416 or not offset:
+            raise
+        # Nothing after ``offset``: the partial is complete only if it has the
+        # length the server reports; otherwise start over.
+        total = _content_range(error.headers)[1]
+        if total is None and validator.get("length"):
+            total = int(validator["length"])
+        if total != offset:
+            os.remove(partial)
+            os.remove(validator_path)
+            return download_to_cache(url, cache_dir)
+
+    digest = _file_digest(partial)
+    os.replace(partial, os.path.join(cache_dir, "objects", digest))
+    os.remove(validator_path)
+    with open(ref, "w") as f:
+        f.write(digest)
+    return digest
+
+
+def fetch_files(
+    urls: Dict[str, str],
+    max_workers: int = 4,
+    cache_dir: str = None,
+    optional: Iterable[str] = (),
+) -> Dict[str, str]:
+    """Download ``{target path: url}`` with a bounded thread pool.
+
+    Files already in the cache are not downloaded again; each target is
+    streamed from the cache and its checksum verified after the copy.
+    Targets in ``optional`` that the server doesn't have (404) are skipped.
+    Returns ``{target path: sha256}`` for the files fetched.
+    """
+    cache_dir = cache_dir or DOWNLOAD_CACHE_DIR
+    optional = set(optional)
+
+    def fetch(target: str, url: str) -> str:
+        try:
+            digest = download_to_cache(url, cache_dir)
+        except HTTPError as error:
+            if error.code == 404 and target in optional:
+                return None
+            raise
+        local_target = _local_path(target)
+        os.makedirs(os.path.dirname(local_target), exist_ok=True)
+        shutil.copyfile(os.path.join(cache_dir, "objects", digest), local_target)
+        if _file_digest(local_target) != digest:
+            raise IOError(f"Checksum mismatch writing {target}")
+        return digest
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            target: executor.submit(fetch, target, url) for target, url in urls.items()
+        }
+        digests = {target: future.result() for target, future in futures.items()}
+    return {target: digest for target, digest in digests.items() if digest}
+
+
 def prepare_activity_data(landingPath) -> bool:
     retrieve_data(CLASSIC_DATA, landingPath)
 
@@ -75,6 +271,196 @@ def ingest_classic_data(hours: int = 1) -> bool:
     return True
 
 
+
+# COMMAND ----------
+
+# Raw archive tier. Processed raw files are regrouped by event-time bucket
+# into gzipped JSON-lines segments under rawArchivePath/<bucket>/, and every
+# segment is recorded in rawArchivePath/_index.json with its time range and
+# record count, so a replay reads only the segments overlapping its window.
+RAW_ARCHIVE_BUCKET_FORMAT = "%Y-%m-%d"
+RAW_ARCHIVE_INDEX = "_index.json"
+
+
+def _event_epoch(record: Dict, time_field: str) -> float:
+    """Event time in epoch seconds, from a numeric or "yyyy-MM-dd HH:mm:ss" field."""
+    value = record[time_field]
+    if isinstance(value, (int, float)):
+        return float(value)
+    return _utc(datetime.fromisoformat(value.replace("Z", "+00:00"))).timestamp()
+
+
+def _utc(moment: datetime) -> datetime:
+    """Naive datetimes are taken to be UTC, matching the Spark session time zone."""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _read_segment(path: str, time_field: str) -> List[Tuple[float, str]]:
+    with gzip.open(path, "rt") as f:
+        return [
+            (_event_epoch(json.loads(line), time_field), line.rstrip("\n"))
+            for line in f
+            if line.strip()
+        ]
+
+
+def _save_raw_archive_index(archive_root: str, entries: List[Dict]) -> None:
+    # DBFS FUSE cannot append to an existing file, so the index is rewritten
+    # whole and swapped into place.
+    index = os.path.join(archive_root, RAW_ARCHIVE_INDEX)
+    with open(index + ".tmp", "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(index + ".tmp", index)
+
+
+def archive_raw_files(
+    rawPath: str, archivePath: str, time_field: str = "time", remove: bool = True
+) -> List[Dict]:
+    """Move every raw file into compressed, time-bucketed archive segments.
+
+    Each bucket keeps a single segment: new records are merged into it and
+    the segment is rewritten. Returns the index entries written. Raw files are
+    removed only after their segments and the index are safely on disk.
+
+    Reruns are safe: files already listed in the index are skipped, and
+    records already in a segment (left by an interrupted run) are not merged
+    again.
+    """
+    raw_root = _local_path(rawPath)
+    archive_root = _local_path(archivePath)
+    if not os.path.isdir(raw_root):
+        return []
+
+    index = {}
+    for entry in read_raw_archive_index(archivePath):
+        index.setdefault(entry["bucket"], []).append(entry)
+    archived = {
+        source
+        for entries in index.values()
+        for entry in entries
+        for source in entry["source_files"]
+    }
+
+    buckets = {}
+    source_files = []
+    archived_files = []
+    for directory, _, files in os.walk(raw_root):
+        for name in files:
+            if name.startswith((".", "_")):
+                continue
+            source = os.path.join(directory, name)
+            if os.path.relpath(source, raw_root) in archived:
+                archived_files.append(source)
+                continue
+            source_files.append(source)
+            with open(source) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    epoch = _event_epoch(json.loads(line), time_field)
+                    bucket = datetime.fromtimestamp(epoch, timezone.utc).strftime(
+                        RAW_ARCHIVE_BUCKET_FORMAT
+                    )
+                    buckets.setdefault(bucket, []).append((epoch, line.rstrip("\n")))
+
+    entries = []
+    replaced = []
+    new_sources = [os.path.relpath(path, raw_root) for path in source_files]
+    for bucket, records in sorted(buckets.items()):
+        previous = index.get(bucket, [])
+        segment = os.path.join(bucket, "segment.json.gz")
+        target = os.path.join(archive_root, segment)
+
+        existing = []
+        for path in {entry["segment"] for entry in previous} | {segment}:
+            path = os.path.join(archive_root, path)
+            if os.path.exists(path):
+                existing.extend(_read_segment(path, time_field))
+        existing_lines = {line for _, line in existing}
+        records = existing + [
+            record for record in records if record[1] not in existing_lines
+        ]
+        records.sort(key=lambda record: record[0])
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with gzip.open(target + ".tmp", "wt") as f:
+            f.write("\n".join(line for _, line in records) + "\n")
+        os.replace(target + ".tmp", target)
+        replaced.extend(
+            entry["segment"] for entry in previous if entry["segment"] != segment
+        )
+
+        sources = [source for entry in previous for source in entry["source_files"]]
+        sources.extend(name for name in new_sources if name not in sources)
+        entry = {
+            "segment": segment,
+            "bucket": bucket,
+            "min_time": records[0][0],
+            "max_time": records[-1][0],
+            "record_count": len(records),
+            "source_files": sources,
+        }
+        index[bucket] = [entry]
+        entries.append(entry)
+
+    if entries:
+        _save_raw_archive_index(
+            archive_root,
+            [entry for _, kept in sorted(index.items()) for entry in kept],
+        )
+    for segment in replaced:
+        path = os.path.join(archive_root, segment)
+        if os.path.exists(path):
+            os.remove(path)
+
+    if remove:
+        for source in source_files + archived_files:
+            os.remove(source)
+    return entries
+
+
+def read_raw_archive_index(archivePath: str) -> List[Dict]:
+    index = os.path.join(_local_path(archivePath), RAW_ARCHIVE_INDEX)
+    if not os.path.exists(index):
+        return []
+    with open(index) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_archived_raw(
+    spark: SparkSession,
+    archivePath: str,
+    start: datetime,
+    end: datetime,
+    time_field: str = "time",
+) -> DataFrame:
+    """Raw ``value`` rows with event time in [start, end), for replay.
+
+    Only archive segments whose indexed time range overlaps the window are
+    read; the result has the same schema as read_batch_raw.
+    """
+    start_epoch, end_epoch = _utc(start).timestamp(), _utc(end).timestamp()
+    segments = [
+        archivePath + entry["segment"]
+        for entry in read_raw_archive_index(archivePath)
+        if entry["min_time"] < end_epoch and entry["max_time"] >= start_epoch
+    ]
+    if not segments:
+        return spark.createDataFrame([], "value STRING")
+
+    event_time = get_json_object(col("value"), f"$.{time_field}")
+    event_epoch = coalesce(
+        event_time.cast("double"), unix_timestamp(event_time).cast("double")
+    )
+    return (
+        spark.read.format("text")
+        .schema("value STRING")
+        .load(segments)
+        .where((event_epoch >= start_epoch) & (event_epoch < end_epoch))
+    )
+
+
 def untilStreamIsReady(namedStream: str, progressions: int = 3) -> bool:
     queries = list(filter(lambda query: query.name == namedStream, spark.streams.active))
     while len(queries) == 0 or len(queries[0].recentProgress) < progressions:
@@ -82,3 +468,1161 @@ def untilStreamIsReady(namedStream: str, progressions: int = 3) -> bool:
         queries = list(filter(lambda query: query.name == namedStream, spark.streams.active))
     print("The stream {} is active and ready.".format(namedStream))
     return True
+
+
+# COMMAND ----------
+
+# Reading the Delta transaction log directly. Only the _delta_log directory is
+# listed; the table's data directories are never touched.
+DELTA_LOG_ACTION_SCHEMA = """
+    add STRUCT<
+        path: STRING,
+        partitionValues: MAP<STRING, STRING>,
+        size: LONG,
+        modificationTime: LONG,
+        dataChange: BOOLEAN,
+        stats: STRING,
+        deletionVector: STRUCT<
+            storageType: STRING,
+            pathOrInlineDv: STRING,
+            offset: INT,
+            sizeInBytes: INT,
+            cardinality: LONG
+        >
+    >,
+    remove STRUCT<
+        path: STRING,
+        deletionTimestamp: LONG,
+        dataChange: BOOLEAN,
+        partitionValues: MAP<STRING, STRING>,
+        size: LONG,
+        deletionVector: STRUCT<
+            storageType: STRING,
+            pathOrInlineDv: STRING,
+            offset: INT,
+            sizeInBytes: INT,
+            cardinality: LONG
+        >
+    >,
+    metaData STRUCT<
+        id: STRING,
+        partitionColumns: ARRAY<STRING>,
+        configuration: MAP<STRING, STRING>
+    >,
+    commitInfo STRUCT<timestamp: LONG, operation: STRING>
+"""
+
+DELTA_FILE_STATS_SCHEMA = """
+    numRecords LONG,
+    minValues MAP<STRING, STRING>,
+    maxValues MAP<STRING, STRING>,
+    nullCount MAP<STRING, LONG>
+"""
+
+
+def list_delta_log(spark: SparkSession, deltaPath: str) -> List[Dict]:
+    """Name, version, size and modification time of every file in _delta_log."""
+    jvm = spark._jvm
+    logPath = jvm.org.apache.hadoop.fs.Path(deltaPath.rstrip("/") + "/_delta_log")
+    fs = logPath.getFileSystem(spark._jsc.hadoopConfiguration())
+    entries = []
+    for status in fs.listStatus(logPath):
+        name = status.getPath().getName()
+        prefix = name.split(".")[0]
+        if not prefix.isdigit():
+            continue
+        entries.append(
+            {
+                "name": name,
+                "path": status.getPath().toString(),
+                "version": int(prefix),
+                "size": status.getLen(),
+                "modificationTime": status.getModificationTime(),
+                "isCheckpoint": ".checkpoint" in name,
+            }
+        )
+    return sorted(entries, key=lambda entry: entry["version"])
+
+
+def read_delta_log_actions(
+    spark: SparkSession, deltaPath: str, version: int = None
+) -> DataFrame:
+    """Actions needed to reconstruct ``version`` (default: latest), tagged by version.
+
+    Replay starts from the newest checkpoint at or below the version, so only
+    the commits written since that checkpoint are read as JSON.
+    """
+    entries = list_delta_log(spark, deltaPath)
+    commits = [entry for entry in entries if entry["name"].endswith(".json")]
+    if version is None:
+        version = commits[-1]["version"]
+
+    checkpoints = [
+        entry
+        for entry in entries
+        if entry["isCheckpoint"] and entry["version"] <= version
+    ]
+    checkpoint_version = checkpoints[-1]["version"] if checkpoints else -1
+
+    actions = None
+    if checkpoints:
+        checkpoint_files = [
+            entry["path"]
+            for entry in checkpoints
+            if entry["version"] == checkpoint_version
+        ]
+        actions = (
+            spark.read.schema(DELTA_LOG_ACTION_SCHEMA)
+            .parquet(*checkpoint_files)
+            .withColumn("version", lit(checkpoint_version).cast("long"))
+        )
+
+    commit_files = [
+        entry["path"]
+        for entry in commits
+        if checkpoint_version < entry["version"] <= version
+    ]
+    if commit_files:
+        commitActions = (
+            spark.read.schema(DELTA_LOG_ACTION_SCHEMA)
+            .json(commit_files)
+            .withColumn(
+                "version",
+                regexp_extract(input_file_name(), r"(\d+)\.json$", 1).cast("long"),
+            )
+        )
+        if actions is None:
+            actions = commitActions
+        else:
+            actions = actions.unionByName(commitActions)
+
+    return actions
+
+
+def _deletion_vector_id(deletionVector: Column) -> Column:
+    """Delta's unique id for a deletion vector; empty when the file has none."""
+    offset = coalesce(concat(lit("@"), deletionVector.offset.cast("string")), lit(""))
+    return coalesce(
+        concat(deletionVector.storageType, deletionVector.pathOrInlineDv, offset),
+        lit(""),
+    )
+
+
+def _latest_file_actions(
+    spark: SparkSession, deltaPath: str, version: int = None
+) -> DataFrame:
+    """The last add or remove action recorded for each file.
+
+    Files are keyed by path and deletion vector, as Delta keys them: a DELETE
+    that writes a deletion vector removes (path, old vector) and adds
+    (path, new vector) in the same commit, and both must survive replay.
+    """
+    actions = read_delta_log_actions(spark, deltaPath, version)
+    fileActions = actions.where("add IS NOT NULL OR remove IS NOT NULL").select(
+        coalesce(col("add.path"), col("remove.path")).alias("path"),
+        _deletion_vector_id(
+            coalesce(col("add.deletionVector"), col("remove.deletionVector"))
+        ).alias("deletion_vector_id"),
+        col("add").isNotNull().alias("is_add"),
+        "add",
+        "remove",
+        "version",
+    )
+    latest = Window.partitionBy("path", "deletion_vector_id").orderBy(
+        col("version").desc(), col("is_add").desc()
+    )
+    return fileActions.withColumn("rank", row_number().over(latest)).where(
+        "rank = 1"
+    )
+
+
+def read_delta_snapshot_files(
+    spark: SparkSession, deltaPath: str, version: int = None
+) -> DataFrame:
+    """The data files live in ``version`` of the table, with their parsed stats.
+
+    ``deletedRows`` counts the rows masked by the file's deletion vector;
+    ``stats.numRecords`` still includes them.
+    """
+    return (
+        _latest_file_actions(spark, deltaPath, version)
+        .where("is_add")
+        .select(
+            "path",
+            col("add.partitionValues").alias("partitionValues"),
+            col("add.size").alias("size"),
+            col("add.modificationTime").alias("modificationTime"),
+            from_json(col("add.stats"), DELTA_FILE_STATS_SCHEMA).alias("stats"),
+            coalesce(col("add.deletionVector.cardinality"), lit(0)).alias(
+                "deletedRows"
+            ),
+            col("add.deletionVector").alias("deletionVector"),
+        )
+    )
+
+
+def read_delta_tombstones(
+    spark: SparkSession, deltaPath: str, version: int = None
+) -> DataFrame:
+    """Files removed from the table but not yet expired from the log.
+
+    A path still live under another deletion vector is not a tombstone.
+    """
+    fileActions = _latest_file_actions(spark, deltaPath, version)
+    live = fileActions.where("is_add").select("path")
+    return (
+        fileActions.where("NOT is_add")
+        .join(live, "path", "left_anti")
+        .dropDuplicates(["path"])
+        .select(
+            "path",
+            col("remove.partitionValues").alias("partitionValues"),
+            col("remove.size").alias("size"),
+            col("remove.deletionTimestamp").alias("deletionTimestamp"),
+            "version",
+        )
+    )
+
+
+# COMMAND ----------
+
+# Partition advisor. Aims for partitions of roughly PARTITION_TARGET_BYTES:
+# the finest granularity whose average partition reaches the target wins,
+# and tables too small for even monthly partitions are left unpartitioned.
+PARTITION_TARGET_BYTES = 1024 ** 3
+PARTITION_GRANULARITY_DAYS = [("day", 1), ("week", 7), ("month", 30)]
+
+
+def partition_volume(
+    spark: SparkSession, deltaPath: str, partition_column: str, version: int = None
+) -> DataFrame:
+    """Files, bytes and records per partition value, from the Delta log alone."""
+    return (
+        read_delta_snapshot_files(spark, deltaPath, version)
+        .groupBy(col("partitionValues")[partition_column].alias(partition_column))
+        .agg(
+            count(lit(1)).alias("num_files"),
+            sum_("size").alias("size_bytes"),
+            (sum_("stats.numRecords") - sum_("deletedRows")).alias("num_records"),
+        )
+    )
+
+
+def recommend_partition_granularity(
+    spark: SparkSession,
+    deltaPath: str,
+    partition_column: str,
+    target_bytes: int = PARTITION_TARGET_BYTES,
+) -> Dict:
+    """Recommend day, week, month or no partitioning for a date-partitioned table."""
+    volume = (
+        partition_volume(spark, deltaPath, partition_column)
+        .agg(
+            sum_("size_bytes").alias("size_bytes"),
+            count(lit(1)).alias("num_partitions"),
+            min_(col(partition_column).cast("date")).alias("first_date"),
+            max_(col(partition_column).cast("date")).alias("last_date"),
+        )
+        .first()
+    )
+    if not volume.num_partitions or volume.first_date is None:
+        return {"granularity": "none", "daily_bytes": 0, "num_partitions": 0}
+
+    days = (volume.last_date - volume.first_date).days + 1
+    daily_bytes = volume.size_bytes / days
+
+    granularity = "none"
+    for candidate, candidate_days in PARTITION_GRANULARITY_DAYS:
+        if daily_bytes * candidate_days >= target_bytes:
+            granularity = candidate
+            break
+
+    return {
+        "granularity": granularity,
+        "daily_bytes": daily_bytes,
+        "num_partitions": volume.num_partitions,
+        "avg_partition_bytes": volume.size_bytes / volume.num_partitions,
+    }
+
+
+# COMMAND ----------
+
+# Delta truncates string min/max statistics to this many characters
+# (delta.dataSkippingStringPrefixLength), so longer values are inexact.
+STATS_STRING_PREFIX_LENGTH = 32
+
+
+def _scan_statistics(dataframe: DataFrame, names: List[str]) -> Dict:
+    """Row count and per-column min, max and null count, by scanning."""
+    types = {field.name: field.dataType.typeName() for field in dataframe.schema}
+    orderable = [name for name in names if types[name] != "map"]
+    return dataframe.agg(
+        count(lit(1)).alias("num_records"),
+        *[min_(name).alias(f"min_{name}") for name in orderable],
+        *[max_(name).alias(f"max_{name}") for name in orderable],
+        *[count(when(col(name).isNull(), 1)).alias(f"nulls_{name}") for name in names],
+    ).first().asDict()
+
+
+def table_statistics(spark: SparkSession, deltaPath: str, version: int = None) -> Dict:
+    """Row count and per-column min, max and null count for a table version.
+
+    Answered from the per-file statistics in the Delta log wherever they are
+    exact. Files without statistics or with a deletion vector are scanned,
+    and only those files. Columns the log cannot answer exactly (beyond
+    dataSkippingNumIndexedCols, or strings whose statistics were truncated)
+    are computed by a scan of just those columns, and listed in
+    ``columns_scanned``.
+    """
+    reader = spark.read.format("delta")
+    if version is not None:
+        reader = reader.option("versionAsOf", version)
+    schema = reader.load(deltaPath).schema
+    files = read_delta_snapshot_files(spark, deltaPath, version).cache()
+    first_file = files.select("partitionValues").first()
+    partition_columns = set(first_file.partitionValues or {}) if first_file else set()
+
+    # Deleted rows are still counted in a file's statistics.
+    exact = col("stats.numRecords").isNotNull() & (col("deletedRows") == 0)
+    aggregates = [
+        count(lit(1)).alias("num_files"),
+        coalesce(sum_("size"), lit(0)).alias("size_bytes"),
+        coalesce(sum_(when(exact, col("stats.numRecords"))), lit(0)).alias(
+            "num_records"
+        ),
+        count(when(exact, 1)).alias("exact_files"),
+        count(when(~exact, 1)).alias("files_to_scan"),
+    ]
+    for field in schema.fields:
+        name, data_type = field.name, field.dataType.simpleString()
+        if name in partition_columns:
+            low = high = col("partitionValues")[name].cast(data_type)
+            nulls = when(low.isNull(), col("stats.numRecords")).otherwise(0)
+            indexed = lit(True)
+        elif field.dataType.typeName() in ("struct", "array", "map"):
+            # Nested statistics don't fit the flat maps; always scanned.
+            low = high = lit(None).cast(data_type)
+            nulls = lit(None).cast("long")
+            indexed = lit(False)
+        else:
+            low = col("stats.minValues")[name].cast(data_type)
+            high = col("stats.maxValues")[name].cast(data_type)
+            nulls = col("stats.nullCount")[name]
+            indexed = nulls.isNotNull()
+        width = greatest(
+            length(col("stats.minValues")[name]), length(col("stats.maxValues")[name])
+        )
+        aggregates += [
+            min_(when(exact, low)).alias(f"min_{name}"),
+            max_(when(exact, high)).alias(f"max_{name}"),
+            coalesce(sum_(when(exact, nulls)), lit(0)).alias(f"nulls_{name}"),
+            count(when(exact & indexed, 1)).alias(f"indexed_{name}"),
+            max_(when(exact, width)).alias(f"width_{name}"),
+        ]
+    logStats = files.agg(*aggregates).first()
+
+    full_scan = [
+        field.name
+        for field in schema.fields
+        if logStats[f"indexed_{field.name}"] < logStats.exact_files
+        or (
+            field.name not in partition_columns
+            and field.dataType.typeName() == "string"
+            and (logStats[f"width_{field.name}"] or 0) >= STATS_STRING_PREFIX_LENGTH
+        )
+    ]
+    statistics = {
+        "version": version,
+        "num_files": logStats.num_files,
+        "size_bytes": logStats.size_bytes,
+        "num_records": logStats.num_records,
+        "files_scanned": logStats.files_to_scan,
+        "columns_scanned": full_scan,
+        "columns": {
+            field.name: {
+                "min": logStats[f"min_{field.name}"],
+                "max": logStats[f"max_{field.name}"],
+                "null_count": logStats[f"nulls_{field.name}"],
+            }
+            for field in schema.fields
+        },
+    }
+
+    if logStats.files_to_scan:
+        # Scan just the files whose statistics are missing or include deleted
+        # rows; deletion vectors are applied to the latter.
+        toScan = files.where(~exact).select("path", "deletedRows").collect()
+        names = [name for name in schema.fieldNames() if name not in full_scan]
+        scan = _scan_statistics(
+            _read_data_files(spark, deltaPath, toScan, version, schema), names
+        )
+        statistics["num_records"] += scan["num_records"]
+        for name in names:
+            column = statistics["columns"][name]
+            lows = [column["min"], scan.get(f"min_{name}")]
+            highs = [column["max"], scan.get(f"max_{name}")]
+            lows = [value for value in lows if value is not None]
+            highs = [value for value in highs if value is not None]
+            column["min"] = min(lows) if lows else None
+            column["max"] = max(highs) if highs else None
+            column["null_count"] += scan[f"nulls_{name}"]
+
+    if full_scan:
+        scan = _scan_statistics(reader.load(deltaPath).select(*full_scan), full_scan)
+        for name in full_scan:
+            statistics["columns"][name] = {
+                "min": scan.get(f"min_{name}"),
+                "max": scan.get(f"max_{name}"),
+                "null_count": scan[f"nulls_{name}"],
+            }
+
+    files.unpersist()
+    return statistics
+
+
+def table_row_count(spark: SparkSession, deltaPath: str, version: int = None) -> int:
+    """Row count from the Delta log; only files without statistics are scanned."""
+    files = read_delta_snapshot_files(spark, deltaPath, version).cache()
+    has_stats = col("stats.numRecords").isNotNull()
+    num_records = (
+        files.where(has_stats)
+        .agg(coalesce(sum_(col("stats.numRecords") - col("deletedRows")), lit(0)))
+        .first()[0]
+    )
+    missing = files.where(~has_stats).select("path", "deletedRows").collect()
+    files.unpersist()
+    if missing:
+        reader = spark.read.format("delta")
+        if version is not None:
+            reader = reader.option("versionAsOf", version)
+        schema = reader.load(deltaPath).schema
+        num_records += _read_data_files(
+            spark, deltaPath, missing, version, schema
+        ).count()
+    return num_records
+
+
+# COMMAND ----------
+
+# Table health analysis from the Delta log alone. Files under TINY_FILE_BYTES
+# are counted as tiny; compaction aims for files of COMPACTION_TARGET_BYTES.
+TINY_FILE_BYTES = 16 * 1024 ** 2
+COMPACTION_TARGET_BYTES = 1024 ** 3
+FILE_SIZE_BUCKETS = [
+    ("lt_1mb", 1024 ** 2),
+    ("lt_16mb", 16 * 1024 ** 2),
+    ("lt_128mb", 128 * 1024 ** 2),
+    ("lt_1gb", 1024 ** 3),
+]
+TOMBSTONE_RETENTION_HOURS = 7 * 24
+LOG_COMMITS_BEFORE_CHECKPOINT = 10
+
+
+def analyze_table_health(spark: SparkSession, deltaPath: str) -> Dict:
+    """Per-partition file layout, log health and ranked maintenance actions.
+
+    Reads only the _delta_log directory. ``partitions`` is a DataFrame with a
+    file-size histogram and tiny-file share per partition; ``actions`` lists
+    compaction, clustering, vacuum and checkpoint recommendations, most
+    valuable first, each with its estimated savings.
+    """
+    files = read_delta_snapshot_files(spark, deltaPath)
+    size = col("size")
+
+    histogram = []
+    lower = lit(0)
+    for name, upper in FILE_SIZE_BUCKETS:
+        histogram.append(count(when((size >= lower) & (size < upper), 1)).alias(name))
+        lower = lit(upper)
+    histogram.append(count(when(size >= lower, 1)).alias("ge_1gb"))
+
+    partitions = (
+        files.groupBy(to_json(col("partitionValues")).alias("partition"))
+        .agg(
+            count(lit(1)).alias("num_files"),
+            sum_("size").alias("size_bytes"),
+            count(when(size < TINY_FILE_BYTES, 1)).alias("tiny_files"),
+            *histogram,
+        )
+        .withColumn("tiny_file_share", col("tiny_files") / col("num_files"))
+        .withColumn(
+            "files_after_compaction",
+            greatest(lit(1), ceil(col("size_bytes") / lit(COMPACTION_TARGET_BYTES))),
+        )
+        .cache()
+    )
+
+    retention_cutoff_ms = (time.time() - TOMBSTONE_RETENTION_HOURS * 3600) * 1000
+    tombstones = (
+        read_delta_tombstones(spark, deltaPath)
+        .agg(
+            count(lit(1)).alias("tombstones"),
+            count(when(col("deletionTimestamp") < retention_cutoff_ms, 1)).alias(
+                "stale_tombstones"
+            ),
+            coalesce(
+                sum_(when(col("deletionTimestamp") < retention_cutoff_ms, col("size"))),
+                lit(0),
+            ).alias("stale_bytes"),
+        )
+        .first()
+    )
+
+    log_entries = list_delta_log(spark, deltaPath)
+    commits = [entry for entry in log_entries if entry["name"].endswith(".json")]
+    checkpoints = [entry for entry in log_entries if entry["isCheckpoint"]]
+    latest_version = commits[-1]["version"] if commits else -1
+    checkpoint_version = checkpoints[-1]["version"] if checkpoints else -1
+    log = {
+        "log_files": len(log_entries),
+        "log_bytes": sum(entry["size"] for entry in log_entries),
+        "latest_version": latest_version,
+        "checkpoint_version": checkpoint_version,
+        "commits_since_checkpoint": latest_version - checkpoint_version,
+        "checkpoint_age_seconds": (
+            time.time() - checkpoints[-1]["modificationTime"] / 1000
+            if checkpoints
+            else None
+        ),
+    }
+
+    actions = []
+    for row in partitions.where(
+        col("num_files") > col("files_after_compaction")
+    ).collect():
+        if row.tiny_files < 2:
+            continue
+        predicate = " AND ".join(
+            f"{name} = '{value}'" for name, value in json.loads(row.partition).items()
+        )
+        statement = f"OPTIMIZE delta.`{deltaPath}`"
+        actions.append(
+            {
+                "action": "compact",
+                "partition": row.partition,
+                "estimated_files_removed": row.num_files - row.files_after_compaction,
+                "detail": f"{statement} WHERE {predicate}" if predicate else statement,
+            }
+        )
+    table = partitions.agg(
+        sum_("num_files").alias("num_files"), sum_("size_bytes").alias("size_bytes")
+    ).first()
+    if table.size_bytes and table.size_bytes >= COMPACTION_TARGET_BYTES:
+        actions.append(
+            {
+                "action": "cluster",
+                "partition": None,
+                "estimated_files_removed": 0,
+                "detail": "ZORDER BY the most selective filter column, e.g. device_id",
+            }
+        )
+    if tombstones.stale_tombstones:
+        actions.append(
+            {
+                "action": "vacuum",
+                "partition": None,
+                "estimated_files_removed": tombstones.stale_tombstones,
+                "estimated_bytes_reclaimed": tombstones.stale_bytes,
+                "detail": (
+                    f"VACUUM delta.`{deltaPath}` "
+                    f"RETAIN {TOMBSTONE_RETENTION_HOURS} HOURS"
+                ),
+            }
+        )
+    if log["commits_since_checkpoint"] > LOG_COMMITS_BEFORE_CHECKPOINT:
+        actions.append(
+            {
+                "action": "checkpoint",
+                "partition": None,
+                "estimated_files_removed": 0,
+                "detail": (
+                    f"{log['commits_since_checkpoint']} JSON commits are replayed "
+                    "on every snapshot load"
+                ),
+            }
+        )
+    actions.sort(
+        key=lambda action: (
+            action.get("estimated_bytes_reclaimed", 0),
+            action["estimated_files_removed"],
+        ),
+        reverse=True,
+    )
+
+    return {
+        "path": deltaPath,
+        "num_files": table.num_files,
+        "size_bytes": table.size_bytes,
+        "tombstones": tombstones.tombstones,
+        "stale_tombstones": tombstones.stale_tombstones,
+        "log": log,
+        "partitions": partitions,
+        "actions": actions,
+    }
+
+
+# COMMAND ----------
+
+# VACUUM planning. Eligible files come from Delta's own VACUUM DRY RUN, which
+# lists the table directory against the live snapshot, so files whose
+# tombstones have aged out of the log and the deletion vector files are
+# covered too. Retention defaults to the table's
+# delta.deletedFileRetentionDuration and is extended back to the oldest table
+# version any active streaming checkpoint may still read.
+VACUUM_STREAM_MARGIN_HOURS = 1
+INTERVAL_UNIT_HOURS = {
+    "week": 7 * 24,
+    "day": 24,
+    "hour": 1,
+    "minute": 1 / 60,
+    "second": 1 / 3600,
+}
+
+
+def _hadoop_path(spark: SparkSession, path: str):
+    jvm = spark._jvm
+    hadoopPath = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoopPath.getFileSystem(spark._jsc.hadoopConfiguration()), hadoopPath
+
+
+def _latest_metadata(spark: SparkSession, deltaPath: str):
+    return (
+        read_delta_log_actions(spark, deltaPath)
+        .where("metaData IS NOT NULL")
+        .orderBy(col("version").desc())
+        .first()
+        .metaData
+    )
+
+
+def delta_table_id(spark: SparkSession, deltaPath: str) -> str:
+    return _latest_metadata(spark, deltaPath).id
+
+
+def _interval_hours(interval: str) -> float:
+    """Hours in a Delta interval property such as "interval 7 days"."""
+    pairs = re.findall(r"(\d+(?:\.\d+)?)\s*([a-z]+?)s?\b", interval.lower())
+    if not pairs:
+        raise ValueError(f"Unrecognised interval: {interval}")
+    return sum(float(amount) * INTERVAL_UNIT_HOURS[unit] for amount, unit in pairs)
+
+
+def deleted_file_retention_hours(spark: SparkSession, deltaPath: str) -> float:
+    """The table's delta.deletedFileRetentionDuration, in hours."""
+    configuration = _latest_metadata(spark, deltaPath).configuration or {}
+    interval = configuration.get("delta.deletedFileRetentionDuration")
+    return TOMBSTONE_RETENTION_HOURS if interval is None else _interval_hours(interval)
+
+
+def streaming_checkpoint_version(
+    spark: SparkSession, checkpointPath: str, tableId: str
+) -> int:
+    """Oldest version of ``tableId`` referenced by a checkpoint's latest offsets."""
+    checkpointPath = checkpointPath.rstrip("/")
+    fs, offsetsPath = _hadoop_path(spark, f"{checkpointPath}/offsets")
+    if not fs.exists(offsetsPath):
+        return None
+    batches = [
+        int(status.getPath().getName())
+        for status in fs.listStatus(offsetsPath)
+        if status.getPath().getName().isdigit()
+    ]
+    if not batches:
+        return None
+    lines = [
+        row.value
+        for row in spark.read.text(f"{checkpointPath}/offsets/{max(batches)}").collect()
+    ]
+    versions = []
+    for line in lines[2:]:
+        offset = json.loads(line) if line.startswith("{") else {}
+        if offset.get("reservoirId") == tableId:
+            versions.append(offset["reservoirVersion"])
+    return min(versions) if versions else None
+
+
+def _vacuum_dry_run(
+    spark: SparkSession, deltaPath: str, retention_hours: float
+) -> List[str]:
+    """Paths Delta's VACUUM would delete at ``retention_hours``.
+
+    A retention shorter than the table's own was asked for explicitly, so
+    Delta's retention safety check is lifted for this one statement.
+    """
+    check = "spark.databricks.delta.retentionDurationCheck.enabled"
+    previous = spark.conf.get(check, "true")
+    if retention_hours < deleted_file_retention_hours(spark, deltaPath):
+        spark.conf.set(check, "false")
+    try:
+        rows = spark.sql(
+            f"VACUUM delta.`{deltaPath}` RETAIN {retention_hours} HOURS DRY RUN"
+        ).collect()
+    finally:
+        spark.conf.set(check, previous)
+    return [row.path for row in rows]
+
+
+def plan_vacuum(
+    spark: SparkSession,
+    deltaPath: str,
+    checkpointPaths: List[str] = [],
+    retention_hours: float = None,
+) -> Dict:
+    """Work out which files can be deleted without breaking readers.
+
+    ``retention_hours`` defaults to the table's deletedFileRetentionDuration.
+    """
+    if retention_hours is None:
+        retention_hours = deleted_file_retention_hours(spark, deltaPath)
+
+    tableId = delta_table_id(spark, deltaPath)
+    stream_versions = [
+        version
+        for version in (
+            streaming_checkpoint_version(spark, checkpoint, tableId)
+            for checkpoint in checkpointPaths
+        )
+        if version is not None
+    ]
+    oldest_stream_version = min(stream_versions) if stream_versions else None
+
+    effective_hours = retention_hours
+    if oldest_stream_version is not None:
+        # Keep everything removed after the oldest version a stream still reads.
+        committed = [
+            entry["modificationTime"]
+            for entry in list_delta_log(spark, deltaPath)
+            if entry["version"] == oldest_stream_version
+            and entry["name"].endswith(".json")
+        ]
+        if committed:
+            age_hours = (time.time() - committed[0] / 1000) / 3600
+            effective_hours = max(
+                retention_hours, age_hours + VACUUM_STREAM_MARGIN_HOURS
+            )
+
+    files = _vacuum_dry_run(spark, deltaPath, effective_hours)
+    fs, _ = _hadoop_path(spark, deltaPath)
+
+    def file_size(path: str) -> int:
+        _, hadoopPath = _hadoop_path(spark, path)
+        return fs.getFileStatus(hadoopPath).getLen() if fs.exists(hadoopPath) else 0
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        sizes = list(executor.map(file_size, files))
+    return {
+        "path": deltaPath,
+        "retention_hours": retention_hours,
+        "effective_retention_hours": effective_hours,
+        "oldest_stream_version": oldest_stream_version,
+        "files": files,
+        "bytes": sum(sizes),
+    }
+
+
+def execute_vacuum(
+    spark: SparkSession,
+    plan: Dict,
+    dry_run: bool = True,
+    batch_size: int = 1000,
+    max_workers: int = 8,
+) -> Dict:
+    """Delete the files in a vacuum plan in parallel batches.
+
+    With ``dry_run`` (the default) nothing is deleted and the report lists
+    what would be.
+    """
+    files = plan["files"]
+    report = {
+        "dry_run": dry_run,
+        "files": len(files),
+        "bytes": plan["bytes"],
+        "oldest_stream_version": plan["oldest_stream_version"],
+    }
+    if dry_run:
+        report["sample"] = files[:20]
+        return report
+
+    fs, _ = _hadoop_path(spark, plan["path"])
+
+    def delete_batch(batch: List[str]) -> List[str]:
+        deleted = []
+        for path in batch:
+            _, hadoopPath = _hadoop_path(spark, path)
+            if fs.delete(hadoopPath, False) or not fs.exists(hadoopPath):
+                deleted.append(path)
+        return deleted
+
+    batches = [files[i : i + batch_size] for i in range(0, len(files), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        deleted = [
+            path for batch in executor.map(delete_batch, batches) for path in batch
+        ]
+
+    report["deleted"] = len(deleted)
+    return report
+
+
+# COMMAND ----------
+
+# Version diff. Only the files added or removed between the two versions are
+# read; rows present on both sides (unchanged rows in rewritten files) cancel
+# out. Files carrying deletion vectors are read through Delta so the vectors
+# apply; all others are read straight from Parquet.
+
+
+def _read_data_files(
+    spark: SparkSession, deltaPath: str, files: List, version: int, schema
+) -> DataFrame:
+    root = deltaPath.rstrip("/")
+    plain = [root + "/" + unquote(f.path) for f in files if not f.deletedRows]
+    masked = [unquote(f.path).split("/")[-1] for f in files if f.deletedRows]
+
+    frames = []
+    if plain:
+        frames.append(
+            spark.read.option("basePath", root)
+            .schema(schema)
+            .parquet(*plain)
+            .select(*schema.fieldNames())
+        )
+    if masked:
+        reader = spark.read.format("delta")
+        if version is not None:
+            reader = reader.option("versionAsOf", version)
+        file_name = regexp_extract(input_file_name(), r"([^/]+)$", 1)
+        frames.append(reader.load(deltaPath).where(file_name.isin(masked)))
+    if not frames:
+        return spark.createDataFrame([], schema)
+    rows = frames[0]
+    for frame in frames[1:]:
+        rows = rows.unionByName(frame)
+    return rows
+
+
+def diff_versions(
+    spark: SparkSession,
+    deltaPath: str,
+    start_version: int,
+    end_version: int = None,
+    key_columns: List[str] = None,
+) -> Dict[str, DataFrame]:
+    """Rows inserted, deleted and updated between two versions of a table.
+
+    With ``key_columns``, a key both deleted and inserted is reported once
+    under ``updated``, as ``before`` and ``after`` structs. Without keys
+    every change is an insert or a delete.
+    """
+    endFiles = read_delta_snapshot_files(spark, deltaPath, end_version)
+    startFiles = read_delta_snapshot_files(spark, deltaPath, start_version)
+    identity = ["path", "deletedRows"]
+    removed = startFiles.join(endFiles.select(*identity), identity, "left_anti")
+    added = endFiles.join(startFiles.select(*identity), identity, "left_anti")
+
+    reader = spark.read.format("delta")
+    if end_version is not None:
+        reader = reader.option("versionAsOf", end_version)
+    schema = reader.load(deltaPath).schema
+
+    before = _read_data_files(
+        spark, deltaPath, removed.collect(), start_version, schema
+    )
+    after = _read_data_files(spark, deltaPath, added.collect(), end_version, schema)
+    inserted, deleted = after.exceptAll(before), before.exceptAll(after)
+
+    if not key_columns:
+        updated_schema = StructType(
+            [StructField("before", schema), StructField("after", schema)]
+        )
+        return {
+            "inserted": inserted,
+            "deleted": deleted,
+            "updated": spark.createDataFrame([], updated_schema),
+        }
+
+    columns = schema.fieldNames()
+    updated = deleted.select(*key_columns, struct(*columns).alias("before")).join(
+        inserted.select(*key_columns, struct(*columns).alias("after")), key_columns
+    )
+    updated_keys = updated.select(*key_columns)
+    return {
+        "inserted": inserted.join(updated_keys, key_columns, "left_anti"),
+        "deleted": deleted.join(updated_keys, key_columns, "left_anti"),
+        "updated": updated,
+    }
+
+
+# COMMAND ----------
+
+# Process-wide cache of Delta table handles and snapshots. Each table keeps
+# one DeltaTable handle and a DataFrame per version, so stages working on the
+# same table share a single snapshot instead of resolving their own. Entries
+# are tied to the table id: a table deleted and recreated at the same path
+# gets a new id, and its stale handle and snapshots are dropped. A change is
+# noticed when the commit file of the cached version is gone or was
+# rewritten. The latest version is refreshed by probing for the commit after
+# the cached one, so only new log entries are touched. The first probe
+# starts from the last checkpoint, and the log directory is listed only when
+# there is none.
+DELTA_SNAPSHOT_CACHE_SIZE = 8
+_DELTA_CACHE = {}
+_DELTA_CACHE_LOCK = threading.Lock()
+
+
+def _commit_marker(spark: SparkSession, deltaPath: str, version: int) -> int:
+    """Modification time of a commit file, or None when there is none."""
+    if version is None or version < 0:
+        return None
+    fs, commit = _hadoop_path(
+        spark, f"{deltaPath.rstrip('/')}/_delta_log/{version:020d}.json"
+    )
+    return fs.getFileStatus(commit).getModificationTime() if fs.exists(commit) else None
+
+
+def _delta_cache_entry(spark: SparkSession, deltaPath: str) -> Dict:
+    """The cache entry for the table currently at ``deltaPath``."""
+    key = deltaPath.rstrip("/")
+    with _DELTA_CACHE_LOCK:
+        entry = _DELTA_CACHE.get(key)
+    if entry is not None and (
+        entry["version"] is None
+        or _commit_marker(spark, deltaPath, entry["version"]) == entry["marker"]
+    ):
+        return entry
+
+    tableId = delta_table_id(spark, deltaPath)
+    with _DELTA_CACHE_LOCK:
+        entry = _DELTA_CACHE.get(key)
+        if entry is None or entry["tableId"] != tableId:
+            entry = {
+                "tableId": tableId,
+                "table": None,
+                "version": None,
+                "marker": None,
+                "snapshots": {},
+            }
+            _DELTA_CACHE[key] = entry
+        return entry
+
+
+def _read_last_checkpoint(spark: SparkSession, deltaPath: str) -> Dict:
+    """The table's _last_checkpoint pointer (version, size, parts), if any."""
+    lastCheckpoint = deltaPath.rstrip("/") + "/_delta_log/_last_checkpoint"
+    fs, hadoopPath = _hadoop_path(spark, lastCheckpoint)
+    if not fs.exists(hadoopPath):
+        return None
+    return json.loads(spark.read.text(lastCheckpoint).first().value)
+
+
+def _last_checkpoint_version(spark: SparkSession, deltaPath: str) -> int:
+    lastCheckpoint = _read_last_checkpoint(spark, deltaPath)
+    return lastCheckpoint["version"] if lastCheckpoint else None
+
+
+def refresh_delta_version(spark: SparkSession, deltaPath: str) -> int:
+    """Latest committed version, reading only log entries newer than the cache."""
+    entry = _delta_cache_entry(spark, deltaPath)
+    version = entry["version"]
+    if version is None:
+        version = _last_checkpoint_version(spark, deltaPath)
+    if version is None:
+        versions = [log["version"] for log in list_delta_log(spark, deltaPath)]
+        version = max(versions) if versions else -1
+
+    logPath = deltaPath.rstrip("/") + "/_delta_log/"
+    fs, _ = _hadoop_path(spark, logPath)
+    while True:
+        _, nextCommit = _hadoop_path(spark, f"{logPath}{version + 1:020d}.json")
+        if not fs.exists(nextCommit):
+            break
+        version += 1
+
+    marker = _commit_marker(spark, deltaPath, version)
+    with _DELTA_CACHE_LOCK:
+        if entry["version"] is None or version >= entry["version"]:
+            entry["version"], entry["marker"] = version, marker
+    return version
+
+
+def delta_table(spark: SparkSession, deltaPath: str) -> DeltaTable:
+    """Shared DeltaTable handle. Operations on it act on the latest version."""
+    # Records the latest commit, so a recreated table is noticed next time.
+    refresh_delta_version(spark, deltaPath)
+    entry = _delta_cache_entry(spark, deltaPath)
+    if entry["table"] is None:
+        table = DeltaTable.forPath(spark, deltaPath)
+        with _DELTA_CACHE_LOCK:
+            if entry["table"] is None:
+                entry["table"] = table
+    return entry["table"]
+
+
+def read_delta_snapshot(
+    spark: SparkSession, deltaPath: str, version: int = None
+) -> DataFrame:
+    """The table as of ``version`` (the latest when None), shared across callers."""
+    if version is None:
+        version = refresh_delta_version(spark, deltaPath)
+    snapshots = _delta_cache_entry(spark, deltaPath)["snapshots"]
+    with _DELTA_CACHE_LOCK:
+        snapshot = snapshots.get(version)
+    if snapshot is None:
+        snapshot = (
+            spark.read.format("delta").option("versionAsOf", version).load(deltaPath)
+        )
+        with _DELTA_CACHE_LOCK:
+            if version not in snapshots:
+                if len(snapshots) >= DELTA_SNAPSHOT_CACHE_SIZE:
+                    snapshots.pop(min(snapshots))
+                snapshots[version] = snapshot
+            snapshot = snapshots[version]
+    return snapshot
+
+
+def invalidate_delta_cache(deltaPath: str = None) -> None:
+    with _DELTA_CACHE_LOCK:
+        if deltaPath is None:
+            _DELTA_CACHE.clear()
+        else:
+            _DELTA_CACHE.pop(deltaPath.rstrip("/"), None)
+
+
+# COMMAND ----------
+
+# Storage access. Notebooks refer to logical locations such as "sales/2004";
+# the first segment names a registered location, which resolves to a wasbs,
+# s3a or local URI. Secrets come from dbutils.secrets, are cached for
+# CREDENTIAL_TTL_SECONDS and applied to the Spark conf only when they change.
+# Hadoop FileSystem clients are kept per scheme and authority and rebuilt
+# when their credential rotates.
+# use_local_storage remaps every location to a local directory, which stands
+# in for Blob and S3 in tests.
+CREDENTIAL_TTL_SECONDS = 15 * 60
+STORAGE_LOCATIONS = {}
+_CREDENTIAL_CACHE = {}
+_FILESYSTEM_CACHE = {}
+_LOCAL_STORAGE_ROOT = None
+_STORAGE_LOCK = threading.Lock()
+
+
+def _secret(scope: str, key: str) -> str:
+    return dbutils.secrets.get(scope=scope, key=key)
+
+
+def register_storage_location(
+    name: str,
+    uri: str,
+    secret_scope: str = None,
+    secret_key: str = None,
+    conf_key: str = None,
+) -> None:
+    """Register a logical location.
+
+    For wasbs URIs ``conf_key`` defaults to the container's SAS setting; for
+    s3a, leave the secret unset to rely on the cluster's IAM role.
+    """
+    match = re.match(r"wasbs://([^@]+)@([^/]+)", uri)
+    if conf_key is None and match:
+        container, host = match.groups()
+        conf_key = f"fs.azure.sas.{container}.{host}"
+    STORAGE_LOCATIONS[name] = {
+        "uri": uri.rstrip("/"),
+        "secret_scope": secret_scope,
+        "secret_key": secret_key,
+        "conf_key": conf_key,
+    }
+
+
+def use_local_storage(root: str = None) -> None:
+    """Resolve every location under ``root`` instead; ``None`` switches back."""
+    global _LOCAL_STORAGE_ROOT
+    _LOCAL_STORAGE_ROOT = root.rstrip("/") if root else None
+
+
+def resolve_location(location: str) -> str:
+    """Concrete URI for a logical location; URIs with a scheme pass through."""
+    if "://" in location or location.startswith(("file:", "dbfs:", "/")):
+        return location
+    name, _, rest = location.partition("/")
+    if name not in STORAGE_LOCATIONS:
+        raise KeyError(f"Unknown storage location: {name}")
+    if _LOCAL_STORAGE_ROOT is not None:
+        base = f"file:{_LOCAL_STORAGE_ROOT}/{name}"
+    else:
+        base = STORAGE_LOCATIONS[name]["uri"]
+    return f"{base}/{rest}" if rest else base
+
+
+def get_credential(
+    scope: str,
+    key: str,
+    fetch: Callable[[str, str], str] = None,
+    ttl: float = CREDENTIAL_TTL_SECONDS,
+) -> str:
+    """Secret from the cache, fetched again once it is older than ``ttl``."""
+    fetch = fetch or _secret
+    with _STORAGE_LOCK:
+        cached = _CREDENTIAL_CACHE.get((scope, key))
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+    value = fetch(scope, key)
+    with _STORAGE_LOCK:
+        _CREDENTIAL_CACHE[(scope, key)] = (value, time.time() + ttl)
+    return value
+
+
+def _location_credential(location: str) -> Tuple[str, str]:
+    """``(conf_key, credential)`` for a location, or None when none applies."""
+    config = STORAGE_LOCATIONS.get(location.partition("/")[0])
+    if (
+        _LOCAL_STORAGE_ROOT is not None
+        or config is None
+        or config["secret_scope"] is None
+        or config["conf_key"] is None
+    ):
+        return None
+    credential = get_credential(config["secret_scope"], config["secret_key"])
+    return config["conf_key"], credential
+
+
+def storage_path(spark: SparkSession, location: str) -> str:
+    """Resolve ``location`` and set its credential in the session conf.
+
+    The session conf is what DataFrame reads and writes use.
+    """
+    uri = resolve_location(location)
+    credential = _location_credential(location)
+    if credential is not None:
+        conf_key, value = credential
+        if spark.conf.get(conf_key, None) != value:
+            spark.conf.set(conf_key, value)
+    return uri
+
+
+def storage_filesystem(spark: SparkSession, location: str):
+    """Hadoop FileSystem for ``location``, shared per scheme and authority.
+
+    The session conf is not visible to FileSystem clients, so each client is
+    built with its own copy of the Hadoop conf carrying the credential. Clients
+    are private instances outside Hadoop's FileSystem cache, and a client is
+    closed and replaced when its credential rotates.
+    """
+    uri = storage_path(spark, location)
+    credential = _location_credential(location)
+    jvm = spark._jvm
+    hadoopUri = jvm.org.apache.hadoop.fs.Path(uri).toUri()
+    key = (hadoopUri.getScheme(), hadoopUri.getAuthority())
+    with _STORAGE_LOCK:
+        cached = _FILESYSTEM_CACHE.get(key)
+        if cached is not None and cached[1] == credential:
+            return cached[0]
+        conf = jvm.org.apache.hadoop.conf.Configuration(
+            spark._jsc.hadoopConfiguration()
+        )
+        if credential is not None:
+            conf.set(*credential)
+        fs = jvm.org.apache.hadoop.fs.FileSystem.newInstance(hadoopUri, conf)
+        _FILESYSTEM_CACHE[key] = (fs, credential)
+        if cached is not None:
+            cached[0].close()
+        return fs
@@ -332,18 +332,21 @@ transformedLateRawDF = transform_raw(lateRawDF)
 # MAGIC ## Merge the Late-Arriving Data with the Bronze Table
 # MAGIC 
 # MAGIC We use the special method `.whenNotMatchedInsertAll` to insert only the records that are not present in the Bronze table. This is a best practice for preventing duplicate entries in a Delta table.
+# MAGIC 
+# MAGIC The merge runs through `execute_merge`, which retries it if the `write_raw_to_bronze` stream commits to the Bronze table at the same time. It is not narrowed by partition: matching existing records must look across every ingest date.
 
 # COMMAND ----------
 
-bronzeTable = DeltaTable.forPath(spark, bronzePath)
-
 existing_record_match = "bronze.value = latearrivals.value"
 
-(
-    bronzeTable.alias("bronze")
-    .merge(transformedLateRawDF.alias("latearrivals"), existing_record_match)
-    .whenNotMatchedInsertAll()
-    .execute()
+execute_merge(
+    spark,
+    bronzePath,
+    build_updates=lambda: transformedLateRawDF,
+    merge_condition=existing_record_match,
+    apply_clauses=lambda merge: merge.whenNotMatchedInsertAll(),
+    target_alias="bronze",
+    source_alias="latearrivals",
 )
 
 # COMMAND ----------
@@ -1,22 +1,55 @@
 # Databricks notebook source
 
+from delta.exceptions import DeltaConcurrentModificationException
 from delta.tables import DeltaTable
-from pyspark.sql import DataFrame
+from pyspark.sql import Column, DataFrame
 from pyspark.sql.functions import (
+    abs,
+    broadcast,
+    ceil,
+    coalesce,
+    collect_list,
     col,
+    count,
     current_timestamp,
+    date_sub,
+    date_trunc,
+    expr,
     from_json,
     from_unixtime,
+    greatest,
     lag,
     lead,
     lit,
+    log,
     mean,
     stddev,
     max,
+    pandas_udf,
+    signum,
+    sqrt,
+    struct,
+    sum as sum_,
+    udf,
+    when,
+    window,
 )
 from pyspark.sql.session import SparkSession
-from pyspark.sql.streaming import DataStreamWriter
+from pyspark.sql.streaming import DataStreamReader, DataStreamWriter, StreamingQuery
+from pyspark.sql.streaming.state import GroupState, GroupStateTimeout
 from pyspark.sql.window import Window
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+import builtins
+import math
+import os
+import random
+import threading
+import time
+import uuid
+import pandas as pd
+import struct as _struct
 
 # COMMAND ----------
 
@@ -26,8 +59,39 @@ def create_stream_writer(
     name: str,
     partition_column: str = None,
     mode: str = "append",
+    targets: List[Dict] = None,
+    metricsPath: str = None,
+    granularity: str = "day",
 ) -> DataStreamWriter:
+    """Streaming Delta writer.
 
+    ``granularity`` coarsens a date partition column to week or month, or
+    drops partitioning with "none"; see with_partition_granularity.
+
+    With ``targets`` the writer fans out instead: each micro-batch is cached
+    once and written to every target by write_fan_out_batch, so start it
+    with ``.start()`` rather than a path.
+    """
+
+    if targets is not None:
+        return (
+            dataframe.writeStream.foreachBatch(
+                lambda microBatchDF, batchId: write_fan_out_batch(
+                    microBatchDF,
+                    batchId,
+                    name,
+                    targets,
+                    metricsPath,
+                    appId=checkpoint_app_id(checkpoint),
+                )
+            )
+            .option("checkpointLocation", checkpoint)
+            .queryName(name)
+        )
+
+    dataframe, partition_column = with_partition_granularity(
+        dataframe, partition_column, granularity
+    )
     stream_writer = (
         dataframe.writeStream.format("delta")
         .outputMode(mode)
@@ -41,15 +105,475 @@ def create_stream_writer(
 
 # COMMAND ----------
 
-def read_stream_delta(spark: SparkSession, deltaPath: str) -> DataFrame:
-    return spark.readStream.format("delta").load(deltaPath)
+def with_partition_granularity(
+    dataframe: DataFrame, partition_column: str, granularity: str = "day"
+) -> (DataFrame, str):
+    """Derive the partition column for a day, week, month or "none" layout.
+
+    Week and month layouts add a column truncating the date partition column,
+    e.g. p_eventdate -> p_eventweek; "none" leaves the data unpartitioned.
+    """
+    if granularity == "day" or partition_column is None:
+        return dataframe, partition_column
+    if granularity == "none":
+        return dataframe, None
+    if granularity not in ("week", "month"):
+        raise ValueError(f"Unknown partition granularity: {granularity}")
+
+    if "date" in partition_column:
+        derived_column = partition_column.replace("date", granularity)
+    else:
+        derived_column = f"{partition_column}_{granularity}"
+    return (
+        dataframe.withColumn(
+            derived_column,
+            date_trunc(granularity, col(partition_column)).cast("date"),
+        ),
+        derived_column,
+    )
+
+
+# COMMAND ----------
+
+def checkpoint_app_id(checkpoint: str) -> str:
+    """Delta transaction app id belonging to a streaming checkpoint.
+
+    A UUID stored inside the checkpoint directory, so resetting the checkpoint
+    also resets the id. A query restarted from batch 0 is then not mistaken
+    for a replay of batches its previous incarnation already committed.
+    """
+    idPath = os.path.join(_local_path(checkpoint), "_txn_app_id")
+    if not os.path.exists(idPath):
+        os.makedirs(os.path.dirname(idPath), exist_ok=True)
+        with open(idPath + ".tmp", "w") as f:
+            f.write(str(uuid.uuid4()))
+        os.replace(idPath + ".tmp", idPath)
+    with open(idPath) as f:
+        return f.read().strip()
+
+
+def write_fan_out_batch(
+    microBatchDF: DataFrame,
+    batchId: int,
+    name: str,
+    targets: List[Dict],
+    metricsPath: str = None,
+    appId: str = None,
+) -> bool:
+    """Write one micro-batch to several Delta targets from a single cached copy.
+
+    Each target is a dict with a ``path``, an optional ``partition_column`` and
+    an optional ``transform`` applied to the micro-batch. Writes carry Delta's
+    txnAppId/txnVersion options, so a batch replayed after a failure is
+    skipped by every target that already committed it. ``appId`` should come
+    from checkpoint_app_id; it defaults to the query name.
+    """
+    appId = appId or name
+    microBatchDF.persist()
+    metrics = []
+
+    for target in targets:
+        transform = target.get("transform")
+        targetDF = transform(microBatchDF) if transform is not None else microBatchDF
+        writer = (
+            targetDF.write.format("delta")
+            .mode("append")
+            .option("txnAppId", appId)
+            .option("txnVersion", batchId)
+        )
+        if target.get("partition_column") is not None:
+            writer = writer.partitionBy(target["partition_column"])
+        writer.save(target["path"])
+        metrics.append((batchId, name, target["path"], targetDF.count()))
+
+    if metricsPath is not None:
+        (
+            microBatchDF.sparkSession.createDataFrame(
+                metrics, "batch_id LONG, query STRING, target STRING, num_rows LONG"
+            )
+            .withColumn("written_at", current_timestamp())
+            .write.format("delta")
+            .mode("append")
+            .option("txnAppId", appId)
+            .option("txnVersion", batchId)
+            .save(metricsPath)
+        )
+
+    microBatchDF.unpersist()
+    return True
+
+
+def medallion_fan_out_targets(
+    bronzePath: str, silverPath: str, quarantinePath: str
+) -> List[Dict]:
+    """Targets writing a raw micro-batch to bronze, silver and quarantine.
+
+    The silver and quarantine transforms re-derive from the cached raw batch,
+    which is cheap; neither re-reads bronze from storage.
+    """
+    rules = QUALITY_RULES["health_tracker_plus_silver"]
+
+    def evaluated(raw: DataFrame) -> DataFrame:
+        return evaluate_quality_rules(transform_bronze(transform_raw(raw)), rules)
+
+    return [
+        {
+            "path": bronzePath,
+            "transform": transform_raw,
+            "partition_column": "p_ingestdate",
+        },
+        {
+            "path": silverPath,
+            "transform": lambda raw: evaluated(raw)
+            .filter("quality_mask = 0")
+            .drop("quality_mask"),
+            "partition_column": "p_eventdate",
+        },
+        {
+            "path": quarantinePath,
+            "transform": lambda raw: evaluated(raw).filter("quality_mask != 0"),
+            "partition_column": "p_eventdate",
+        },
+    ]
 
 
 # COMMAND ----------
 
-def read_stream_raw(spark: SparkSession, rawPath: str) -> DataFrame:
+# Declarative data-quality rules, keyed by the table the rows are headed for.
+# Supported rule types:
+#   not_null     {"column"}
+#   range        {"column", "min" and/or "max"}
+#   regex        {"column", "pattern"}
+#   referential  {"column", "values"} or {"column", "table", "reference_column"}
+#   freshness    {"column", "max_age"}  e.g. "30 days"
+QUALITY_RULES = {
+    "health_tracker_plus_silver": [
+        {"name": "device_id_not_null", "type": "not_null", "column": "device_id"},
+        {
+            "name": "heartrate_not_negative",
+            "type": "range",
+            "column": "heartrate",
+            "min": 0,
+        },
+    ],
+}
+
+
+def compile_quality_rule(rule: Dict, matched: Column = None) -> Column:
+    """Return a boolean Column that is true when a row passes the rule.
+
+    A table-backed referential rule needs ``matched``, the flag column that
+    evaluate_quality_rules joins in from the reference table.
+    """
+    column = col(rule["column"])
+    rule_type = rule["type"]
+
+    if rule_type == "not_null":
+        passes = column.isNotNull()
+    elif rule_type == "range":
+        passes = lit(True)
+        if rule.get("min") is not None:
+            passes = passes & (column >= lit(rule["min"]))
+        if rule.get("max") is not None:
+            passes = passes & (column <= lit(rule["max"]))
+    elif rule_type == "regex":
+        passes = column.rlike(rule["pattern"])
+    elif rule_type == "referential":
+        if rule.get("values") is not None:
+            passes = column.isin(list(rule["values"]))
+        elif matched is not None:
+            passes = matched
+        else:
+            raise ValueError(
+                f"Rule {rule['name']} reads {rule['table']}; "
+                "evaluate it with evaluate_quality_rules"
+            )
+    elif rule_type == "freshness":
+        passes = column >= current_timestamp() - expr(f"INTERVAL {rule['max_age']}")
+    else:
+        raise ValueError(f"Unknown quality rule type: {rule_type}")
+
+    # A rule that cannot be evaluated (null input) counts as a failure.
+    return coalesce(passes, lit(False))
+
+
+def evaluate_quality_rules(
+    dataframe: DataFrame, rules: List[Dict], mask_column: str = "quality_mask"
+) -> DataFrame:
+    """Add a bitmask column where bit i is set when the row fails rules[i].
+
+    All rules are compiled into a single projection so the input is read once.
+    A referential rule backed by a table is checked with a broadcast join
+    against the table's distinct keys rather than a literal IN list.
+    """
+    if len(rules) > 63:
+        raise ValueError("At most 63 quality rules fit in the bitmask")
+
+    mask = lit(0).cast("long")
+    flags = []
+    for bit, rule in enumerate(rules):
+        matched = None
+        if rule["type"] == "referential" and rule.get("values") is None:
+            flag = f"_{mask_column}_reference_{bit}"
+            reference = (
+                dataframe.sparkSession.read.table(rule["table"])
+                .select(col(rule.get("reference_column", rule["column"])).alias(flag))
+                .distinct()
+            )
+            dataframe = dataframe.join(
+                broadcast(reference), col(rule["column"]) == reference[flag], "left"
+            )
+            matched = col(flag).isNotNull()
+            flags.append(flag)
+        failed = ~compile_quality_rule(rule, matched)
+        mask = mask + when(failed, lit(1 << bit)).otherwise(0)
+    return dataframe.withColumn(mask_column, mask).drop(*flags)
+
+
+def quality_rule_counters(
+    rules: List[Dict], mask_column: str = "quality_mask"
+) -> List[Column]:
+    """Failure count per rule, plus totals, computed from the bitmask column."""
+    failures = [
+        count(when(col(mask_column).bitwiseAND(1 << bit) != 0, 1)).alias(rule["name"])
+        for bit, rule in enumerate(rules)
+    ]
+    return [
+        count(lit(1)).alias("rows_evaluated"),
+        count(when(col(mask_column) != 0, 1)).alias("rows_quarantined"),
+        *failures,
+    ]
+
+
+# COMMAND ----------
+
+def generate_clean_and_quarantine_dataframes(
+    dataframe: DataFrame,
+    rules: List[Dict] = None,
+    observation=None,
+) -> (DataFrame, DataFrame):
+    """Split a DataFrame into rows passing every quality rule and rows to quarantine.
+
+    The quarantine DataFrame keeps the ``quality_mask`` column so the failing
+    rules can be traced. Pass an ``Observation`` (or a name, for streams) to
+    collect the per-rule counters in the same pass that writes the batch.
+
+    Nothing is cached here. When both outputs are written, cache
+    ``dataframe`` first and unpersist it once both writes have finished.
+    """
+    if rules is None:
+        rules = QUALITY_RULES["health_tracker_plus_silver"]
+
+    evaluated = evaluate_quality_rules(dataframe, rules)
+    if observation is not None:
+        evaluated = evaluated.observe(observation, *quality_rule_counters(rules))
+
+    return (
+        evaluated.filter("quality_mask = 0").drop("quality_mask"),
+        evaluated.filter("quality_mask != 0"),
+    )
+
+
+# COMMAND ----------
+
+def execute_merge(
+    spark: SparkSession,
+    deltaPath: str,
+    build_updates: Callable[[], DataFrame],
+    merge_condition: str,
+    apply_clauses: Callable,
+    partition_column: str = None,
+    target_alias: str = "target",
+    source_alias: str = "updates",
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+) -> Dict:
+    """Run a MERGE that tolerates concurrent writers to the same table.
+
+    When ``partition_column`` is given, the merge condition is narrowed to the
+    partition values present in the updates, so Delta's conflict detection
+    only checks those partitions and appends elsewhere do not conflict. On a
+    concurrent-modification conflict the updates are rebuilt against the new
+    snapshot and the MERGE is retried after a jittered exponential backoff.
+    Returns the number of attempts and conflicts.
+    """
+    conflicts = 0
+    for attempt in range(max_retries + 1):
+        updatesDF = build_updates()
+        condition = merge_condition
+        if partition_column is not None:
+            values = [
+                row[0]
+                for row in updatesDF.select(partition_column).distinct().collect()
+            ]
+            if not values:
+                return {"attempts": attempt + 1, "conflicts": conflicts}
+            value_list = ", ".join(f"'{value}'" for value in values)
+            condition = (
+                f"{target_alias}.{partition_column} IN ({value_list}) "
+                f"AND ({merge_condition})"
+            )
+
+        merge_builder = (
+            delta_table(spark, deltaPath)
+            .alias(target_alias)
+            .merge(updatesDF.alias(source_alias), condition)
+        )
+        try:
+            apply_clauses(merge_builder).execute()
+            return {"attempts": attempt + 1, "conflicts": conflicts}
+        except DeltaConcurrentModificationException:
+            conflicts += 1
+            if attempt == max_retries:
+                raise
+            time.sleep(base_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# COMMAND ----------
+
+def _with_admission_control(
+    reader: DataStreamReader, max_files: int = None, max_bytes: str = None
+) -> DataStreamReader:
+    """Cap how much data a single micro-batch may admit.
+
+    ``max_bytes`` is a soft limit such as "1g"; Delta sources always honor
+    it, file sources where the runtime supports it. With both set, a batch
+    stops at whichever limit it reaches first.
+    """
+    if max_files is not None:
+        reader = reader.option("maxFilesPerTrigger", max_files)
+    if max_bytes is not None:
+        reader = reader.option("maxBytesPerTrigger", max_bytes)
+    return reader
+
+
+def read_stream_delta(
+    spark: SparkSession,
+    deltaPath: str,
+    max_files: int = None,
+    max_bytes: str = None,
+    skip_change_commits: bool = False,
+) -> DataFrame:
+    """Delta table stream.
+
+    Rows soft-deleted through deletion vectors are never emitted. By default
+    a commit that deletes or updates existing rows stops the stream, as
+    before. Set ``skip_change_commits`` to ignore those commits so that
+    compliance deletes on the source don't interrupt it.
+    """
+    reader = _with_admission_control(
+        spark.readStream.format("delta"), max_files, max_bytes
+    )
+    if skip_change_commits:
+        reader = reader.option("skipChangeCommits", "true")
+    return reader.load(deltaPath)
+
+
+# COMMAND ----------
+
+def read_stream_raw(
+    spark: SparkSession,
+    rawPath: str,
+    max_files: int = None,
+    max_bytes: str = None,
+    sourceArchivePath: str = None,
+) -> DataFrame:
+    """Raw text stream.
+
+    With ``sourceArchivePath`` each file is moved there once its batch has
+    committed, so the directory listed every trigger only holds the unread
+    backlog. Pair it with stage_new_raw_files to read from a staging
+    directory instead of the ever-growing landing zone.
+    """
     kafka_schema = "value STRING"
-    return spark.readStream.format("text").schema(kafka_schema).load(rawPath)
+    reader = _with_admission_control(
+        spark.readStream.format("text").schema(kafka_schema), max_files, max_bytes
+    )
+    if sourceArchivePath is not None:
+        reader = reader.option("cleanSource", "archive").option(
+            "sourceArchiveDir", sourceArchivePath
+        )
+    return reader.load(rawPath)
+
+
+# COMMAND ----------
+
+def recommend_admission_limit(
+    progress: List[Dict],
+    limit: int,
+    target_seconds: float,
+    max_growth: float = 2.0,
+) -> int:
+    """Scale a per-trigger limit so batches take about ``target_seconds``.
+
+    Uses the trigger durations of recent non-empty batches. Growth is capped
+    at ``max_growth`` per step, so a stream recovering from an outage ramps up
+    instead of admitting the whole backlog at once.
+    """
+    durations = [
+        batch["durationMs"]["triggerExecution"] / 1000
+        for batch in progress
+        if batch.get("numInputRows")
+    ]
+    if not durations:
+        return limit
+    observed = sum(durations) / len(durations)
+    scale = target_seconds / observed if observed else max_growth
+    # max and abs are the Spark column functions in this notebook.
+    return int(builtins.max(1, min(limit * max_growth, limit * scale)))
+
+
+def run_adaptive_admission(
+    start_query: Callable[[int], StreamingQuery],
+    initial_limit: int,
+    target_seconds: float,
+    poll_seconds: float = 60,
+    tolerance: float = 0.25,
+) -> Dict:
+    """Keep a query's per-trigger limit tuned to a target batch duration.
+
+    ``start_query(limit)`` must start the query with that limit, e.g. by
+    passing it as ``max_files`` to read_stream_raw. A background thread
+    checks recent progress every ``poll_seconds`` and, when the recommended
+    limit differs by more than ``tolerance``, restarts the query from its
+    checkpoint with the new limit. Returns a dict holding the current
+    ``query`` and ``limit``, updated as the controller runs.
+    """
+    state = {"limit": initial_limit, "query": start_query(initial_limit)}
+
+    def control() -> None:
+        while state["query"].isActive:
+            time.sleep(poll_seconds)
+            query = state["query"]
+            limit = recommend_admission_limit(
+                query.recentProgress, state["limit"], target_seconds
+            )
+            if builtins.abs(limit - state["limit"]) > tolerance * state["limit"]:
+                query.stop()
+                state["limit"] = limit
+                state["query"] = start_query(limit)
+
+    state["thread"] = threading.Thread(target=control, daemon=True)
+    state["thread"].start()
+    return state
+
+
+# COMMAND ----------
+
+def read_stream_socket(
+    spark: SparkSession, host: str = "localhost", port: int = 9999
+) -> DataFrame:
+    """Raw stream from a socket, e.g. one fed by replay_events and socket_sink.
+
+    The socket source yields the same single ``value STRING`` column as
+    read_stream_raw, so transform_raw applies unchanged.
+    """
+    return (
+        spark.readStream.format("socket")
+        .option("host", host)
+        .option("port", port)
+        .load()
+    )
 
 
 # COMMAND ----------
@@ -66,28 +590,33 @@ def update_silver_table(spark: SparkSession, silverPath: str) -> bool:
 
     dateWindow = Window.orderBy("p_eventdate")
 
-    interpolatedDF = spark.read.table("health_tracker_plus_silver").select(
-        "*",
-        lag(col("heartrate")).over(dateWindow).alias("prev_amt"),
-        lead(col("heartrate")).over(dateWindow).alias("next_amt"),
-    )
-
-    updatesDF = interpolatedDF.where(col("heartrate") < 0).select(
-        "device_id",
-        ((col("prev_amt") + col("next_amt")) / 2).alias("heartrate"),
-        "eventtime",
-        "name",
-        "p_eventdate",
-    )
+    def build_updates() -> DataFrame:
+        # Rebuilt on every attempt so a retry sees the latest silver snapshot.
+        interpolatedDF = read_delta_snapshot(spark, silverPath).select(
+            "*",
+            lag(col("heartrate")).over(dateWindow).alias("prev_amt"),
+            lead(col("heartrate")).over(dateWindow).alias("next_amt"),
+        )
 
-    silverTable = DeltaTable.forPath(spark, silverPath)
+        return interpolatedDF.where(col("heartrate") < 0).select(
+            "device_id",
+            ((col("prev_amt") + col("next_amt")) / 2).alias("heartrate"),
+            "eventtime",
+            "name",
+            "p_eventdate",
+        )
 
-    (
-        silverTable.alias("health_tracker")
-        .merge(updatesDF.alias("updates"), update_match)
-        .whenMatchedUpdate(set=update)
-        .execute()
+    metrics = execute_merge(
+        spark,
+        silverPath,
+        build_updates=build_updates,
+        merge_condition=update_match,
+        apply_clauses=lambda merge: merge.whenMatchedUpdate(set=update),
+        partition_column="p_eventdate",
+        target_alias="health_tracker",
     )
+    if metrics["conflicts"]:
+        print(f"update_silver_table retried after {metrics['conflicts']} conflicts.")
 
     return True
 
@@ -134,10 +663,686 @@ def transform_silver_mean_agg(silver: DataFrame) -> DataFrame:
 
 # COMMAND ----------
 
-def transform_silver_mean_agg_last_thirty(silver: DataFrame) -> DataFrame:
-    health_tracker_gold_aggregate_heartrate = spark.read.table(
-        "health_tracker_gold_aggregate_heartrate"
+def transform_silver_daily_partials(silver: DataFrame) -> DataFrame:
+    """Per-device, per-day partial aggregates that combine into any date range."""
+    return silver.groupBy("device_id", "p_eventdate").agg(
+        count(col("heartrate")).alias("count_heartrate"),
+        sum_(col("heartrate")).alias("sum_heartrate"),
+        sum_(col("heartrate") * col("heartrate")).alias("sum_sq_heartrate"),
+        max(col("heartrate")).alias("max_heartrate"),
+    )
+
+
+def refresh_daily_partials(
+    spark: SparkSession, silverPath: str, dailyPath: str, dates: List[str]
+) -> bool:
+    """Recompute the daily partials for ``dates`` only, replacing those partitions.
+
+    Only the silver partitions for the given dates are read, so refreshing after
+    a day of new data costs one day of data, and rerunning is idempotent.
+    """
+    if not dates:
+        return False
+
+    date_list = ", ".join(f"'{date}'" for date in dates)
+    predicate = f"p_eventdate IN ({date_list})"
+    dailyDF = transform_silver_daily_partials(
+        spark.read.format("delta").load(silverPath).where(predicate)
+    )
+    (
+        dailyDF.write.format("delta")
+        .mode("overwrite")
+        .option("replaceWhere", predicate)
+        .partitionBy("p_eventdate")
+        .save(dailyPath)
+    )
+    return True
+
+
+def transform_rolling_window_agg(
+    daily: DataFrame, end_date: str, days: int = 30
+) -> DataFrame:
+    """Combine the ``days`` daily partials ending at ``end_date``.
+
+    ``end_date`` ("yyyy-MM-dd") is required: the sample data is from 2020, so a
+    window ending today would be empty.
+    """
+    end = lit(end_date).cast("date")
+    n = col("count_heartrate")
+    return (
+        daily.where(
+            (col("p_eventdate") > date_sub(end, days)) & (col("p_eventdate") <= end)
+        )
+        .groupBy("device_id")
+        .agg(
+            sum_("count_heartrate").alias("count_heartrate"),
+            sum_("sum_heartrate").alias("sum_heartrate"),
+            sum_("sum_sq_heartrate").alias("sum_sq_heartrate"),
+            max("max_heartrate").alias("max_heartrate"),
+        )
+        .select(
+            "device_id",
+            (col("sum_heartrate") / n).alias("mean_heartrate"),
+            sqrt(
+                (col("sum_sq_heartrate") - col("sum_heartrate") ** 2 / n) / (n - 1)
+            ).alias("std_heartrate"),
+            "max_heartrate",
+            "count_heartrate",
+        )
+    )
+
+
+def transform_silver_mean_agg_last_thirty(
+    silver: DataFrame, end_date: str
+) -> DataFrame:
+    """Thirty-day aggregates rebuilt from silver.
+
+    This rescans a month of silver on every call; read_mean_agg_last_thirty
+    reads the stored daily partials instead.
+    """
+    return transform_rolling_window_agg(
+        transform_silver_daily_partials(silver), end_date, days=30
+    )
+
+
+def read_mean_agg_last_thirty(
+    spark: SparkSession, dailyPath: str, end_date: str
+) -> DataFrame:
+    """Thirty-day aggregates from the partials kept by refresh_daily_partials.
+
+    The date filter prunes the ``p_eventdate`` partitions, so only thirty small
+    daily partitions are read instead of a month of silver.
+    """
+    return transform_rolling_window_agg(
+        spark.read.format("delta").load(dailyPath), end_date, days=30
+    )
+
+
+# COMMAND ----------
+
+# Tumbling windows for the pre-bucketed gold tables: table suffix -> window length.
+GOLD_WINDOWS = {"hourly": "1 hour", "daily": "1 day"}
+
+
+def transform_silver_windowed_agg(
+    silver: DataFrame, window_duration: str, watermark: str = "1 hour"
+) -> DataFrame:
+    """Per-device heart-rate aggregates over tumbling event-time windows.
+
+    The watermark on ``eventtime`` lets the stream run in append mode: each
+    window is emitted once, after the watermark passes its end, and its state
+    is then dropped.
+    """
+    return (
+        silver.withWatermark("eventtime", watermark)
+        .groupBy("device_id", window(col("eventtime"), window_duration))
+        .agg(
+            mean(col("heartrate")).alias("mean_heartrate"),
+            stddev(col("heartrate")).alias("std_heartrate"),
+            max(col("heartrate")).alias("max_heartrate"),
+            count(col("heartrate")).alias("count_heartrate"),
+        )
+        .select(
+            "device_id",
+            col("window.start").alias("window_start"),
+            col("window.end").alias("window_end"),
+            "mean_heartrate",
+            "std_heartrate",
+            "max_heartrate",
+            "count_heartrate",
+            col("window.start").cast("date").alias("p_eventdate"),
+        )
+    )
+
+
+def create_windowed_gold_writers(
+    silver: DataFrame, checkpoint: str, watermark: str = "1 hour"
+) -> Dict[str, DataStreamWriter]:
+    """One append-mode stream writer per entry in GOLD_WINDOWS."""
+    return {
+        suffix: create_stream_writer(
+            dataframe=transform_silver_windowed_agg(silver, duration, watermark),
+            checkpoint=checkpoint + f"aggregate_heartrate_{suffix}/",
+            name=f"write_silver_to_gold_{suffix}",
+            partition_column="p_eventdate",
+        )
+        for suffix, duration in GOLD_WINDOWS.items()
+    }
+
+
+# COMMAND ----------
+
+# Mergeable heart-rate quantile sketch. Values are mapped to logarithmic
+# buckets with a bounded relative error, so a sketch is just a map of
+# bucket -> count: merging two sketches adds their counts, and any range of
+# days can be combined at query time. Keys are signed so negative readings
+# sort below zero and positive readings.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_MIN_MAGNITUDE = 1e-3
+SKETCH_KEY_OFFSET = 1000
+_SKETCH_HEADER = "<Bd"
+_SKETCH_ENTRY = "<iq"
+_SKETCH_VERSION = 1
+
+
+def heartrate_sketch_key(value: float) -> int:
+    if value == 0:
+        return 0
+    magnitude = math.fabs(value)
+    if magnitude < SKETCH_MIN_MAGNITUDE:
+        magnitude = SKETCH_MIN_MAGNITUDE
+    key = math.ceil(math.log(magnitude) / math.log(SKETCH_GAMMA)) + SKETCH_KEY_OFFSET
+    return key if value > 0 else -key
+
+
+def _heartrate_sketch_key_column(column: Column) -> Column:
+    """Spark equivalent of heartrate_sketch_key."""
+    magnitude = greatest(abs(column), lit(SKETCH_MIN_MAGNITUDE))
+    key = ceil(log(magnitude) / lit(math.log(SKETCH_GAMMA))) + SKETCH_KEY_OFFSET
+    return when(column == 0, lit(0)).otherwise(signum(column).cast("int") * key)
+
+
+def serialize_heartrate_sketch(buckets: Dict[int, int]) -> bytes:
+    payload = [_struct.pack(_SKETCH_HEADER, _SKETCH_VERSION, SKETCH_GAMMA)]
+    for key in sorted(buckets):
+        payload.append(_struct.pack(_SKETCH_ENTRY, key, buckets[key]))
+    return b"".join(payload)
+
+
+def deserialize_heartrate_sketch(sketch: bytes) -> Dict[int, int]:
+    header_size = _struct.calcsize(_SKETCH_HEADER)
+    version, gamma = _struct.unpack_from(_SKETCH_HEADER, sketch)
+    if version != _SKETCH_VERSION or gamma != SKETCH_GAMMA:
+        raise ValueError("Incompatible heart-rate sketch")
+    return {
+        key: bucket_count
+        for key, bucket_count in _struct.iter_unpack(
+            _SKETCH_ENTRY, bytes(sketch[header_size:])
+        )
+    }
+
+
+def build_heartrate_sketch(values: Iterable[float]) -> bytes:
+    buckets = {}
+    for value in values:
+        key = heartrate_sketch_key(value)
+        buckets[key] = buckets.get(key, 0) + 1
+    return serialize_heartrate_sketch(buckets)
+
+
+def merge_heartrate_sketches(*sketches: bytes) -> bytes:
+    buckets = {}
+    for sketch in sketches:
+        if sketch is None:
+            continue
+        for key, bucket_count in deserialize_heartrate_sketch(sketch).items():
+            buckets[key] = buckets.get(key, 0) + bucket_count
+    return serialize_heartrate_sketch(buckets)
+
+
+def heartrate_sketch_quantile(sketch: bytes, quantile: float) -> float:
+    buckets = deserialize_heartrate_sketch(sketch)
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    rank = quantile * (total - 1)
+    seen = 0
+    for key in sorted(buckets):
+        seen += buckets[key]
+        if seen > rank:
+            break
+    if key == 0:
+        return 0.0
+    exponent = math.fabs(key) - SKETCH_KEY_OFFSET
+    value = 2 * SKETCH_GAMMA ** exponent / (SKETCH_GAMMA + 1)
+    return value if key > 0 else -value
+
+
+@udf("binary")
+def _sketch_from_buckets(buckets) -> bytes:
+    return serialize_heartrate_sketch({row.key: row.bucket_count for row in buckets})
+
+
+@udf("binary")
+def _merge_sketch_pair(left: bytes, right: bytes) -> bytes:
+    return merge_heartrate_sketches(left, right)
+
+
+@pandas_udf("binary")
+def merge_heartrate_sketch_agg(sketches: pd.Series) -> bytes:
+    """Aggregate function merging a column of sketches, e.g. across days."""
+    return merge_heartrate_sketches(*sketches)
+
+
+@udf("double")
+def heartrate_sketch_quantile_udf(sketch: bytes, quantile: float) -> float:
+    return heartrate_sketch_quantile(sketch, quantile)
+
+
+# COMMAND ----------
+
+def transform_silver_heartrate_sketch(silver: DataFrame) -> DataFrame:
+    """One sketch per device and day, built from native bucket counts."""
+    return (
+        silver.where(col("heartrate").isNotNull())
+        .groupBy(
+            "device_id",
+            "p_eventdate",
+            _heartrate_sketch_key_column(col("heartrate")).alias("key"),
+        )
+        .agg(count(lit(1)).alias("bucket_count"))
+        .groupBy("device_id", "p_eventdate")
+        .agg(
+            _sketch_from_buckets(collect_list(struct("key", "bucket_count"))).alias(
+                "heartrate_sketch"
+            )
+        )
     )
-    return silver.join(
-        spark.read.table("health_tracker_gold_aggregate_heartrate"), "device_id"
-    ).where("p_eventdate > cast('2020-03-01' AS DATE) - 30")
+
+
+def upsert_heartrate_sketches(
+    spark: SparkSession,
+    microBatchDF: DataFrame,
+    sketchPath: str,
+    batchId: int = None,
+    appId: str = None,
+) -> bool:
+    """Merge the sketches of one silver micro-batch into the gold sketch table.
+
+    Merging a sketch adds its counts, so a replayed batch must not be merged
+    twice. With ``batchId`` and ``appId`` the write carries Delta's
+    transaction id, and Delta skips a batch it has already committed. Only
+    the gold partitions for the batch's event dates are read.
+    """
+    # foreachBatch runs on the query's own session; the table handle and the
+    # transaction conf must both come from it for Delta to see the conf.
+    session = microBatchDF.sparkSession
+    batchSketchDF = transform_silver_heartrate_sketch(microBatchDF)
+
+    if not DeltaTable.isDeltaTable(session, sketchPath):
+        writer = batchSketchDF.write.format("delta").partitionBy("p_eventdate")
+        if batchId is not None:
+            writer = writer.option("txnAppId", appId).option("txnVersion", batchId)
+        writer.save(sketchPath)
+        return True
+
+    dates = [row[0] for row in batchSketchDF.select("p_eventdate").distinct().collect()]
+    if not dates:
+        return True
+    date_list = ", ".join(f"'{date}'" for date in dates)
+    in_batch_dates = f"p_eventdate IN ({date_list})"
+
+    sketchTable = DeltaTable.forPath(session, sketchPath)
+    mergedDF = (
+        batchSketchDF.alias("updates")
+        .join(
+            sketchTable.toDF().where(in_batch_dates).alias("gold"),
+            ["device_id", "p_eventdate"],
+            "left",
+        )
+        .select(
+            "device_id",
+            "p_eventdate",
+            _merge_sketch_pair(
+                col("gold.heartrate_sketch"), col("updates.heartrate_sketch")
+            ).alias("heartrate_sketch"),
+        )
+    )
+
+    update_match = f"""
+    gold.{in_batch_dates}
+    AND
+    gold.device_id = updates.device_id
+    AND
+    gold.p_eventdate = updates.p_eventdate
+  """
+
+    # MERGE takes the transaction id from the session conf, which only this
+    # query's session sees.
+    if batchId is not None:
+        session.conf.set("spark.databricks.delta.write.txnAppId", appId)
+        session.conf.set("spark.databricks.delta.write.txnVersion", str(batchId))
+    try:
+        (
+            sketchTable.alias("gold")
+            .merge(mergedDF.alias("updates"), update_match)
+            .whenMatchedUpdate(set={"heartrate_sketch": "updates.heartrate_sketch"})
+            .whenNotMatchedInsertAll()
+            .execute()
+        )
+    finally:
+        if batchId is not None:
+            session.conf.unset("spark.databricks.delta.write.txnAppId")
+            session.conf.unset("spark.databricks.delta.write.txnVersion")
+
+    return True
+
+
+def create_heartrate_sketch_writer(
+    spark: SparkSession, silver: DataFrame, checkpoint: str, sketchPath: str
+) -> DataStreamWriter:
+    return (
+        silver.writeStream.foreachBatch(
+            lambda microBatchDF, batchId: upsert_heartrate_sketches(
+                spark,
+                microBatchDF,
+                sketchPath,
+                batchId=batchId,
+                appId=checkpoint_app_id(checkpoint),
+            )
+        )
+        .option("checkpointLocation", checkpoint)
+        .queryName("write_silver_to_gold_sketch")
+    )
+
+
+def heartrate_percentiles(sketches: DataFrame, start: str, end: str) -> DataFrame:
+    """p50, p95 and p99 heart rate per device between two dates, inclusive."""
+    def percentile(quantile: float) -> Column:
+        return heartrate_sketch_quantile_udf(col("sketch"), lit(quantile))
+
+    return (
+        sketches.where(col("p_eventdate").between(start, end))
+        .groupBy("device_id")
+        .agg(merge_heartrate_sketch_agg(col("heartrate_sketch")).alias("sketch"))
+        .select(
+            "device_id",
+            percentile(0.5).alias("p50_heartrate"),
+            percentile(0.95).alias("p95_heartrate"),
+            percentile(0.99).alias("p99_heartrate"),
+        )
+    )
+
+
+# COMMAND ----------
+
+# Per-device running heart-rate statistics in the streaming state store: an
+# exponentially weighted mean and variance with weight max(1/n, ANOMALY_DECAY),
+# which is the exact running mean and variance over the first readings and
+# tracks a lasting baseline change afterwards. Readings outside the
+# physiological bounds, or more than ANOMALY_Z_SCORE standard deviations from
+# the running mean, are emitted as alerts. Out-of-bounds readings are sensor
+# errors and left out of the statistics; z-score outliers are folded in, so
+# a sustained shift stops alerting once the statistics have adapted.
+ANOMALY_Z_SCORE = 4.0
+ANOMALY_MIN_READINGS = 10
+ANOMALY_DECAY = 0.05
+ANOMALY_HEARTRATE_BOUNDS = (20.0, 250.0)
+ANOMALY_STATE_TIMEOUT_MS = 24 * 60 * 60 * 1000
+
+ANOMALY_STATE_SCHEMA = "count LONG, mean DOUBLE, variance DOUBLE"
+ANOMALY_OUTPUT_SCHEMA = """
+    device_id INTEGER,
+    eventtime TIMESTAMP,
+    heartrate DOUBLE,
+    running_mean DOUBLE,
+    running_std DOUBLE,
+    z_score DOUBLE,
+    reason STRING,
+    p_eventdate DATE
+"""
+
+
+def detect_heartrate_anomalies(
+    key: Tuple, readings: Iterator[pd.DataFrame], state: GroupState
+) -> Iterator[pd.DataFrame]:
+    if state.hasTimedOut:
+        # The device has been idle for ANOMALY_STATE_TIMEOUT_MS; free its state.
+        state.remove()
+        return
+
+    n, mean_, variance = state.get if state.exists else (0, 0.0, 0.0)
+    low, high = ANOMALY_HEARTRATE_BOUNDS
+    alerts = []
+
+    for pdf in readings:
+        for row in pdf.sort_values("eventtime").itertuples(index=False):
+            heartrate = row.heartrate
+            if heartrate is None or math.isnan(heartrate):
+                continue
+
+            std = math.sqrt(variance)
+            z_score = (heartrate - mean_) / std if std > 0 else 0.0
+
+            reason = None
+            if heartrate < low or heartrate > high:
+                reason = "out_of_bounds"
+            elif n >= ANOMALY_MIN_READINGS and math.fabs(z_score) > ANOMALY_Z_SCORE:
+                reason = "z_score"
+
+            if reason is not None:
+                alerts.append(
+                    (key[0], row.eventtime, heartrate, mean_, std, z_score, reason)
+                )
+            if reason == "out_of_bounds":
+                continue
+
+            n += 1
+            weight = builtins.max(1.0 / n, ANOMALY_DECAY)
+            delta = heartrate - mean_
+            mean_ += weight * delta
+            variance = (1 - weight) * (variance + weight * delta * delta)
+
+    state.update((n, mean_, variance))
+    state.setTimeoutDuration(ANOMALY_STATE_TIMEOUT_MS)
+
+    if alerts:
+        alertsPDF = pd.DataFrame(
+            alerts,
+            columns=[
+                "device_id",
+                "eventtime",
+                "heartrate",
+                "running_mean",
+                "running_std",
+                "z_score",
+                "reason",
+            ],
+        )
+        alertsPDF["p_eventdate"] = pd.to_datetime(alertsPDF["eventtime"]).dt.date
+        yield alertsPDF
+
+
+def transform_silver_heartrate_anomalies(silver: DataFrame) -> DataFrame:
+    return silver.groupBy("device_id").applyInPandasWithState(
+        detect_heartrate_anomalies,
+        outputStructType=ANOMALY_OUTPUT_SCHEMA,
+        stateStructType=ANOMALY_STATE_SCHEMA,
+        outputMode="append",
+        timeoutConf=GroupStateTimeout.ProcessingTimeTimeout,
+    )
+
+
+def create_heartrate_anomaly_writer(
+    spark: SparkSession, silver: DataFrame, checkpoint: str
+) -> DataStreamWriter:
+    """Stream anomaly alerts to a gold table, with state held in RocksDB.
+
+    RocksDB keeps per-device state on local disk rather than the JVM heap, so
+    the number of tracked devices is not bounded by executor memory. The
+    provider is fixed when a checkpoint is created.
+    """
+    spark.conf.set(
+        "spark.sql.streaming.stateStore.providerClass",
+        "org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider",
+    )
+    return create_stream_writer(
+        dataframe=transform_silver_heartrate_anomalies(silver),
+        checkpoint=checkpoint,
+        name="write_silver_to_gold_alerts",
+        partition_column="p_eventdate",
+    )
+
+
+# COMMAND ----------
+
+BACKFILL_RESULT_SCHEMA = """
+    chunk STRING,
+    bronze_rows LONG,
+    silver_rows LONG,
+    seconds DOUBLE,
+    rows_per_second DOUBLE
+"""
+
+
+def backfill_month(
+    spark: SparkSession,
+    year: int,
+    month: int,
+    rawPath: str,
+    bronzePath: str,
+    silverPath: str,
+    include_late: bool = False,
+    fetch: Callable = None,
+    run_id: str = None,
+) -> Dict:
+    """Load one month raw -> bronze -> silver with batch reads, idempotently.
+
+    The bronze append carries a Delta transaction id for the month and
+    ``run_id``, so retrying within a run does not duplicate it while a new run
+    loads the month again. Silver replaces only that month's p_eventdate
+    range, so concurrent months touch disjoint partitions and never conflict.
+
+    A month's late file holds the whole month, so with ``include_late`` it is
+    loaded instead of the regular file; months without one fall back to the
+    regular file.
+    """
+    fetch = fetch or retrieve_data
+    started = time.time()
+    chunk = f"{year}_{month:02d}"
+    app_id = f"backfill_{run_id}_{chunk}" if run_id else f"backfill_{chunk}"
+
+    rawFile = None
+    if include_late:
+        try:
+            fetch(year, month, rawPath, is_late=True)
+            rawFile = f"{rawPath}late/health_tracker_data_{year}_{month}_late.json"
+        except HTTPError as error:
+            if error.code != 404:
+                raise
+    if rawFile is None:
+        fetch(year, month, rawPath, is_late=False)
+        rawFile = f"{rawPath}health_tracker_data_{year}_{month}.json"
+
+    rawDF = spark.read.format("text").schema("value STRING").load(rawFile)
+    bronzeDF = transform_raw(rawDF).dropDuplicates(["value"]).cache()
+    (
+        bronzeDF.write.format("delta")
+        .mode("append")
+        .option("txnAppId", app_id)
+        .option("txnVersion", 0)
+        .partitionBy("p_ingestdate")
+        .save(bronzePath)
+    )
+
+    first_day = f"{year}-{month:02d}-01"
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    next_first_day = f"{next_year}-{next_month:02d}-01"
+    month_predicate = (
+        f"p_eventdate >= '{first_day}' AND p_eventdate < '{next_first_day}'"
+    )
+    silverDF = transform_bronze(bronzeDF).where(month_predicate)
+    (
+        silverDF.write.format("delta")
+        .mode("overwrite")
+        .option("replaceWhere", month_predicate)
+        .partitionBy("p_eventdate")
+        .save(silverPath)
+    )
+
+    bronze_rows = bronzeDF.count()
+    silver_rows = silverDF.count()
+    bronzeDF.unpersist()
+    seconds = time.time() - started
+    return {
+        "chunk": chunk,
+        "bronze_rows": bronze_rows,
+        "silver_rows": silver_rows,
+        "seconds": seconds,
+        "rows_per_second": bronze_rows / seconds if seconds else None,
+    }
+
+
+def run_backfill(
+    spark: SparkSession,
+    start: Tuple[int, int],
+    end: Tuple[int, int],
+    rawPath: str,
+    bronzePath: str,
+    silverPath: str,
+    backfillLogPath: str,
+    max_workers: int = 4,
+    include_late: bool = False,
+    fetch: Callable = None,
+    run_id: str = None,
+) -> DataFrame:
+    """Backfill every month from ``start`` to ``end`` (inclusive ``(year, month)``).
+
+    Months run concurrently on a bounded thread pool. Each finished month is
+    recorded, with its throughput, in the Delta table at ``backfillLogPath``;
+    months already recorded there are skipped. Pass the ``run_id`` printed by
+    a failed backfill to resume it without duplicating bronze; a new run
+    reloads any month whose log row was deleted. Returns the backfill log.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    print(f"Backfill run {run_id}")
+
+    # Created up front: concurrent first writes to a missing table would race
+    # to write version 0 and fail a month after its data had loaded.
+    emptyRawDF = spark.createDataFrame([], "value STRING")
+    for emptyDF, path, partition_column in [
+        (transform_raw(emptyRawDF), bronzePath, "p_ingestdate"),
+        (transform_bronze(transform_raw(emptyRawDF)), silverPath, "p_eventdate"),
+        (
+            spark.createDataFrame([], BACKFILL_RESULT_SCHEMA).withColumn(
+                "completed_at", current_timestamp()
+            ),
+            backfillLogPath,
+            None,
+        ),
+    ]:
+        if not DeltaTable.isDeltaTable(spark, path):
+            writer = emptyDF.write.format("delta").mode("ignore")
+            if partition_column is not None:
+                writer = writer.partitionBy(partition_column)
+            writer.save(path)
+    completed = {
+        row.chunk for row in spark.read.format("delta").load(backfillLogPath).collect()
+    }
+
+    months = []
+    year, month = start
+    while (year, month) <= end:
+        if f"{year}_{month:02d}" not in completed:
+            months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def run_month(year_month: Tuple[int, int]) -> Dict:
+        result = backfill_month(
+            spark,
+            *year_month,
+            rawPath,
+            bronzePath,
+            silverPath,
+            include_late=include_late,
+            fetch=fetch,
+            run_id=run_id,
+        )
+        (
+            spark.createDataFrame([result], BACKFILL_RESULT_SCHEMA)
+            .withColumn("completed_at", current_timestamp())
+            .write.format("delta")
+            .mode("append")
+            .save(backfillLogPath)
+        )
+        print(
+            f"Backfilled {result['chunk']}: {result['bronze_rows']} rows "
+            f"in {result['seconds']:.1f}s ({result['rows_per_second']:.0f} rows/s)"
+        )
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_month, months))
+
+    return spark.read.format("delta").load(backfillLogPath)
@@ -5,8 +5,10 @@
 
 # COMMAND ----------
 
+import pandas as pd
 import pytest
 from pyspark.sql import SparkSession
+from pyspark.sql.functions import col
 from pyspark.sql.types import *
 
 # COMMAND ----------
@@ -22,7 +24,19 @@ spark = sql.SparkSession.builder.master("local[8]").getOrCreate()
 
 # COMMAND ----------
 
-from main.python.operations import transform_raw
+from main.python.operations import (
+    detect_heartrate_anomalies,
+    build_heartrate_sketch,
+    heartrate_sketch_quantile,
+    merge_heartrate_sketches,
+    QUALITY_RULES,
+    evaluate_quality_rules,
+    generate_clean_and_quarantine_dataframes,
+    transform_raw,
+    transform_rolling_window_agg,
+    transform_silver_daily_partials,
+    transform_silver_windowed_agg,
+)
 
 # COMMAND ----------
 
@@ -69,3 +83,149 @@ def test_transform_raw(spark_session: SparkSession):
             StructField("p_ingestdate", DateType(), False),
         ]
     )
+
+
+# COMMAND ----------
+
+def test_evaluate_quality_rules(spark_session: SparkSession):
+    testDF = spark_session.createDataFrame(
+        [(0, 52.8), (None, 53.9), (1, -60.0), (None, -1.0)],
+        schema="device_id INTEGER, heartrate DOUBLE",
+    )
+    evaluatedDF = evaluate_quality_rules(
+        testDF, QUALITY_RULES["health_tracker_plus_silver"]
+    )
+    assert [row.quality_mask for row in evaluatedDF.collect()] == [0, 1, 2, 3]
+
+
+def test_evaluate_quality_rules_referential_table(spark_session: SparkSession):
+    spark_session.createDataFrame(
+        [(0,), (0,), (1,)], schema="id INTEGER"
+    ).createOrReplaceTempView("test_known_devices")
+    testDF = spark_session.createDataFrame(
+        [(0, 52.8), (2, 53.9), (None, 54.0), (1, 55.1)],
+        schema="device_id INTEGER, heartrate DOUBLE",
+    )
+    rules = [
+        {
+            "name": "device_id_known",
+            "type": "referential",
+            "column": "device_id",
+            "table": "test_known_devices",
+            "reference_column": "id",
+        }
+    ]
+    evaluatedDF = evaluate_quality_rules(testDF, rules)
+    assert evaluatedDF.columns == ["device_id", "heartrate", "quality_mask"]
+    masks = {row.heartrate: row.quality_mask for row in evaluatedDF.collect()}
+    assert masks == {52.8: 0, 53.9: 1, 54.0: 1, 55.1: 0}
+
+
+# COMMAND ----------
+
+def test_generate_clean_and_quarantine_dataframes(spark_session: SparkSession):
+    testDF = spark_session.createDataFrame(
+        [(0, 52.8), (None, 53.9), (1, -60.0)],
+        schema="device_id INTEGER, heartrate DOUBLE",
+    )
+    cleanDF, quarantineDF = generate_clean_and_quarantine_dataframes(testDF)
+    assert cleanDF.columns == ["device_id", "heartrate"]
+    assert cleanDF.count() == 1
+    assert quarantineDF.count() == 2
+
+
+# COMMAND ----------
+
+def test_transform_silver_windowed_agg(spark_session: SparkSession):
+    testDF = spark_session.createDataFrame(
+        [
+            (0, 50.0, "2020-01-01 00:10:00"),
+            (0, 60.0, "2020-01-01 00:50:00"),
+            (0, 70.0, "2020-01-01 01:10:00"),
+        ],
+        schema="device_id INTEGER, heartrate DOUBLE, eventtime STRING",
+    ).withColumn("eventtime", col("eventtime").cast("timestamp"))
+    hourlyDF = transform_silver_windowed_agg(testDF, "1 hour").orderBy("window_start")
+    rows = hourlyDF.collect()
+    assert [row.count_heartrate for row in rows] == [2, 1]
+    assert rows[0].mean_heartrate == 55.0
+    assert rows[0].max_heartrate == 60.0
+
+
+# COMMAND ----------
+
+def test_merge_heartrate_sketches():
+    values = [float(value) for value in range(40, 140)]
+    merged = merge_heartrate_sketches(
+        build_heartrate_sketch(values[:50]), build_heartrate_sketch(values[50:])
+    )
+    assert merged == build_heartrate_sketch(values)
+    assert abs(heartrate_sketch_quantile(merged, 0.5) - 89.0) <= 0.01 * 89.0
+    assert abs(heartrate_sketch_quantile(merged, 0.99) - 138.0) <= 0.01 * 138.0
+
+
+# COMMAND ----------
+
+def test_transform_rolling_window_agg(spark_session: SparkSession):
+    testDF = spark_session.createDataFrame(
+        [
+            (0, 50.0, "2020-01-01"),
+            (0, 60.0, "2020-01-30"),
+            (0, 70.0, "2020-01-31"),
+            (0, 80.0, "2020-01-31"),
+        ],
+        schema="device_id INTEGER, heartrate DOUBLE, p_eventdate STRING",
+    ).withColumn("p_eventdate", col("p_eventdate").cast("date"))
+    dailyDF = transform_silver_daily_partials(testDF)
+    row = transform_rolling_window_agg(dailyDF, "2020-01-31", days=30).first()
+    assert row.count_heartrate == 3
+    assert row.mean_heartrate == 70.0
+    assert row.std_heartrate == 10.0
+    assert row.max_heartrate == 80.0
+
+
+# COMMAND ----------
+
+class FakeGroupState:
+    def __init__(self):
+        self.hasTimedOut = False
+        self.exists = False
+        self.get = None
+
+    def update(self, value):
+        self.exists = True
+        self.get = value
+
+    def setTimeoutDuration(self, durationMs):
+        self.timeout = durationMs
+
+
+def test_detect_heartrate_anomalies():
+    state = FakeGroupState()
+    readings = pd.DataFrame(
+        {
+            "eventtime": pd.date_range("2020-01-01", periods=13, freq="h"),
+            "heartrate": [60.0, 61.0, 59.0, 60.5, 59.5] * 2 + [60.0, 180.0, -5.0],
+        }
+    )
+    alerts = pd.concat(list(detect_heartrate_anomalies((0,), iter([readings]), state)))
+    assert list(alerts["reason"]) == ["z_score", "out_of_bounds"]
+    # The z-score outlier is folded into the statistics; the sensor error is not.
+    assert state.get[0] == 12
+
+
+def test_detect_heartrate_anomalies_adapts_to_baseline_shift():
+    state = FakeGroupState()
+    heartrates = [60.0 + (i % 5 - 2) * 0.5 for i in range(50)]
+    heartrates += [75.0 + (i % 5 - 2) * 0.5 for i in range(500)]
+    readings = pd.DataFrame(
+        {
+            "eventtime": pd.date_range("2020-01-01", periods=550, freq="min"),
+            "heartrate": heartrates,
+        }
+    )
+    alerts = pd.concat(list(detect_heartrate_anomalies((0,), iter([readings]), state)))
+    assert 0 < len(alerts) < 50
+    assert alerts["eventtime"].max() < readings["eventtime"].iloc[100]
+    assert state.get[0] == 550
+    assert abs(state.get[1] - 75.0) < 1.0